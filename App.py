@@ -11,12 +11,10 @@ from gevent.pywsgi import WSGIServer
 from api.http.HttpRouter import Router
 from api.websocket.WsHandler import handle
 from config import log_config
-from config.common_config import FILE_DIR
+from config.common_config import FILE_DIR, DOWNLOAD_X_SENDFILE
+from utils import metrics
+from utils.storage import StorageJanitor
 
-log_config.init()
-os.makedirs(FILE_DIR, exist_ok=True)
-app = Flask(__name__)
-CORS(app, resources=r'/*', supports_credentials=True)
 logger = logging.getLogger(__name__)
 
 async def start_websocket_server():
@@ -32,11 +30,21 @@ def run_websocket_server():
 
 
 if __name__ == '__main__':
+    # Only in the server process: worker pools spawn their processes by importing this module as __mp_main__, and
+    # metrics.reset would remove the metrics files of all running processes.
+    log_config.init()
+    os.makedirs(FILE_DIR, exist_ok=True)
+    metrics.reset()
+    app = Flask(__name__)
+    app.config["USE_X_SENDFILE"] = DOWNLOAD_X_SENDFILE
+    CORS(app, resources=r'/*', supports_credentials=True)
+
     # start websocket server and http server
     websocket_thread = threading.Thread(target=run_websocket_server)
     websocket_thread.setDaemon(True)
     websocket_thread.start()
 
+    StorageJanitor().start()
     routes = Router(app)
     http_server = WSGIServer(('0.0.0.0', 8080), app)
     http_server.serve_forever()
@@ -15,3 +15,7 @@ class ApiResponse(BaseModel):
     @staticmethod
     def fail(msg, data):
         return ApiResponse(code=-1, msg=msg, data=data)
+
+    @staticmethod
+    def progress(data):
+        return ApiResponse(code=0, msg="progress", data=data)
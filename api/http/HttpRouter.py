@@ -1,6 +1,7 @@
 from flask import request, send_from_directory
 
 from service.download_service import download
+from service.metrics_service import get_metrics
 
 
 class Router:
@@ -13,6 +14,10 @@ class Router:
         def download_file():
             return download(request)
 
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            return get_metrics()
+
         @self.app.route('/index.html')
         def serve_index():
             return send_from_directory('static', 'index.html')
@@ -1,34 +1,134 @@
+import asyncio
 import json
 import logging
 
+from websockets.exceptions import ConnectionClosed
+
 from api.ApiResponse import ApiResponse
+from config.common_config import JOB_SUBMIT_BACKLOG_PER_CONNECTION
 from service.compile_video_service import CompileVideoService, CompileVideoParam
-from service.img_service import ImgService, ImgResizeParam
+from service.img_service import ImgService, ImgResizeParam, ImgResizeBatchParam
+from service.job_queue import create_job_queue
+from service.job_scheduler import JOB_KIND_RENDER, JOB_KIND_IO
+from utils.job_context import JobCancelled
+from utils.log_utils import payload
 
 logger = logging.getLogger(__name__)
 
+scheduler = create_job_queue()
+
 
 async def handle(websocket):
-    async for message in websocket:
-        logger.info("handle ws begin, message:%s", message)
-        try:
-            data = json.loads(message)
-        except Exception as e:
-            logger.error("handle ws error, parse param fail, message:%s, error:%s", message, e, exc_info=True)
-            await websocket.send(ApiResponse.fail(str(e), None).json())
-            return
+    connection_id = websocket.id
+    # Keep references to the reply tasks, the event loop only holds weak references.
+    replies = set()
+    # reply task -> task_id, of the jobs still waiting for room in the job queue.
+    submitting = {}
+    try:
+        async for message in websocket:
+            logger.info("handle ws begin, message:%s", payload(message))
+            try:
+                data = json.loads(message)
+            except Exception as e:
+                logger.error("handle ws error, parse param fail, message:%s, error:%s", payload(message, sample=False), e,
+                             exc_info=True)
+                await websocket.send(ApiResponse.fail(str(e), None).json())
+                return
+
+            try:
+                task_id = data["task_id"]
+                if data["type"] == "cancel":
+                    # The reply of the cancelled job reports the cancellation.
+                    found = scheduler.cancel(connection_id, task_id)
+                    for reply_task, submitted_task_id in list(submitting.items()):
+                        if submitted_task_id == task_id:
+                            reply_task.cancel()
+                            found = True
+                    if not found:
+                        await websocket.send(ApiResponse.fail("task not found", {"task_id": task_id}).json())
+                    continue
+
+                job = None
+                if data["type"] == "compile_video":
+                    job = (JOB_KIND_RENDER, CompileVideoService.compile_video, task_id,
+                           CompileVideoParam.model_validate(data.get("param")))
+                elif data["type"] == "img_resize":
+                    job = (JOB_KIND_IO, ImgService.resize_img, task_id, ImgResizeParam.model_validate(data.get("param")))
+                elif data["type"] == "img_resize_batch":
+                    job = (JOB_KIND_IO, ImgService.resize_img_batch, task_id,
+                           ImgResizeBatchParam.model_validate(data.get("param")))
+                if job is not None and len(submitting) >= JOB_SUBMIT_BACKLOG_PER_CONNECTION:
+                    await websocket.send(ApiResponse.fail("too many pending tasks", {"task_id": task_id}).json())
+                    continue
+            except Exception as e:
+                logger.error("handle ws error, task_id:%s, error:%s", data.get("task_id"), e, exc_info=True)
+                await websocket.send(ApiResponse.fail(str(e), {"task_id": data.get("task_id")}).json())
+                continue
+
+            if job is None:
+                result = asyncio.get_running_loop().create_future()
+                result.set_result({})
+                reply_task = asyncio.create_task(reply(websocket, task_id, result))
+            else:
+                # The job waits for room in the job queue in a task of its own, the connection keeps reading
+                # messages, cancels included.
+                reply_task = asyncio.create_task(submit(websocket, connection_id, task_id, job, replies, submitting))
+                submitting[reply_task] = task_id
+            replies.add(reply_task)
+            reply_task.add_done_callback(replies.discard)
+    finally:
+        for reply_task in list(submitting):
+            reply_task.cancel()
+        scheduler.release_connection(connection_id)
+
+
+async def submit(websocket, connection_id, task_id, job, replies, submitting):
+    try:
+        # Waits while the job queue is full.
+        result = await scheduler.submit(connection_id, *job, task_id=task_id,
+                                        on_progress=lambda event: send_progress(websocket, event, replies))
+    except asyncio.CancelledError:
+        logger.info("handle ws cancelled, task_id:%s", task_id)
+        await send(websocket, ApiResponse.fail("task cancelled", {"task_id": task_id}).json())
+        return
+    except Exception as e:
+        logger.error("handle ws error, task_id:%s, error:%s", task_id, e, exc_info=True)
+        await send(websocket, ApiResponse.fail(str(e), {"task_id": task_id}).json())
+        return
+    finally:
+        submitting.pop(asyncio.current_task(), None)
+    await reply(websocket, task_id, result)
+
+
+def send_progress(websocket, event, replies):
+    data = {key: value for key, value in event.items() if key != "job_id"}
+    progress_task = asyncio.create_task(send(websocket, ApiResponse.progress(data).json()))
+    replies.add(progress_task)
+    progress_task.add_done_callback(replies.discard)
+
+
+async def send(websocket, message):
+    try:
+        await websocket.send(message)
+    except ConnectionClosed:
+        pass
+
 
+async def reply(websocket, task_id, result_future):
+    try:
+        result = await result_future
+        result["task_id"] = task_id
+        await websocket.send(ApiResponse.success(result).json())
+        logger.info("handle ws end, result:%s", payload(result))
+    except (asyncio.CancelledError, JobCancelled):
+        # Cancelled while queued, or while running.
+        logger.info("handle ws cancelled, task_id:%s", task_id)
+        await send(websocket, ApiResponse.fail("task cancelled", {"task_id": task_id}).json())
+    except ConnectionClosed:
+        logger.info("handle ws connection closed, task_id:%s", task_id)
+    except Exception as e:
+        logger.error("handle ws error, task_id:%s, error:%s", task_id, e, exc_info=True)
         try:
-            result = {}
-            if data["type"] == "compile_video":
-                result = CompileVideoService.compile_video(data["task_id"],
-                                                           CompileVideoParam.model_validate(data.get("param")))
-            elif data["type"] == "img_resize":
-                result = ImgService.resize_img(data["task_id"], ImgResizeParam.model_validate(data.get("param")))
-
-            result["task_id"] = data["task_id"]
-            await websocket.send(ApiResponse.success(result).json())
-            logger.info("handle ws end, result:%s", json.dumps(result))
-        except Exception as e:
-            logger.error("handle ws error, task_id:%s, error:%s", data["task_id"], e, exc_info=True)
-            await websocket.send(ApiResponse.fail(str(e), {"task_id": data["task_id"]}).json())
+            await websocket.send(ApiResponse.fail(str(e), {"task_id": task_id}).json())
+        except ConnectionClosed:
+            logger.info("handle ws connection closed, task_id:%s", task_id)
@@ -0,0 +1,265 @@
+"""
+Benchmark of the compile_video pipeline on synthetic materials.
+
+Every workload renders in a fresh process with its own working directory, so the material and render caches are
+cold and the peak RSS is its own. Materials are served by a local HTTP server and downloaded like in production.
+
+    python -m benchmark.compile_video_benchmark --output baseline.json
+    python -m benchmark.compile_video_benchmark --shots 1,10 --compare baseline.json
+"""
+import argparse
+import functools
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmark.materials import generate_materials, CAPTIONS_EN, CAPTIONS_CJK
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MATERIAL_DIR = "./tmp/benchmark/materials/"
+
+
+def build_param(base_url, shots, orientation, captions, shot_duration, profile=None, segmented=None,
+                preview=False, engine=None) -> dict:
+    """
+    A compile_video param mixing solid image, video and noise image shots, with English and CJK captions.
+    """
+    shot_params = []
+    for index in range(shots):
+        kind = ("solid", "video", "noise")[index % 3]
+        shot = {"audio": base_url + "narration.mp3"}
+        if kind == "video":
+            shot["video"] = base_url + f"video_{orientation}.mp4"
+        else:
+            shot["img"] = base_url + f"{kind}_{orientation}.png"
+        texts = CAPTIONS_EN if index % 2 == 0 else CAPTIONS_CJK
+        if captions == "v1":
+            shot["caption"] = texts[index // 2 % len(texts)]
+        else:
+            half = int(shot_duration * 500)
+            shot["captions"] = {"type": 1, "items": [
+                {"text": texts[0], "startTime": 0, "endTime": half},
+                {"text": texts[1], "startTime": half, "endTime": half * 2},
+            ]}
+        shot_params.append(shot)
+    return {"bgm": base_url + "bgm.mp3", "shots": shot_params, "profile": profile, "segmented": segmented,
+            "preview": preview, "engine": engine}
+
+
+def run_workload(name, param, font_path) -> dict:
+    """
+    Render one workload, runs in its own process.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix="omni-editor-benchmark-")
+    os.chdir(work_dir)
+    try:
+        from config.common_config import FILE_DIR, CAPTION_FONT
+        from service.compile_video_service import CompileVideoService, CompileVideoParam
+        from utils.job_context import JobContext
+        from utils.media_probe import probe
+        from utils.storage import output_path
+
+        os.makedirs(FILE_DIR, exist_ok=True)
+        if font_path and os.path.exists(font_path):
+            os.symlink(font_path, CAPTION_FONT)
+        subprocesses = _count_subprocesses()
+
+        manager = multiprocessing.get_context("spawn").Manager()
+        events = manager.Queue()
+        stage_ends = {}
+        drain = threading.Thread(target=_drain_events, args=(events, stage_ends), daemon=True)
+        drain.start()
+
+        compile_param = CompileVideoParam.model_validate(param)
+        started = time.perf_counter()
+        result = CompileVideoService.compile_video(name, compile_param, JobContext(name, 0, events))
+        wall_time = time.perf_counter() - started
+
+        events.put(None)
+        drain.join()
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        manager.shutdown()
+
+        stages = {}
+        previous_end = 0
+        for stage, end in sorted(stage_ends.items(), key=lambda item: item[1]):
+            stages[stage] = round(end - started - previous_end, 3)
+            previous_end = end - started
+        stages["finish"] = round(wall_time - previous_end, 3)
+
+        info = probe(output_path(result["video"]))
+        fps = CompileVideoService.get_profile(compile_param).fps
+        frames = round(info.video_duration * fps)
+        return {
+            "name": name,
+            "shots": len(compile_param.shots),
+            "wall_time": round(wall_time, 3),
+            "stages": stages,
+            "cpu_time": round(self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime +
+                              children_usage.ru_stime, 3),
+            # ru_maxrss is in KiB on Linux.
+            "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+            "children_peak_rss_mb": round(children_usage.ru_maxrss / 1024, 1),
+            "subprocesses": subprocesses["count"],
+            "output_duration": round(info.video_duration, 3),
+            "output_frames": frames,
+            "frames_per_second": round(frames / wall_time, 2),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _count_subprocesses():
+    """
+    Count the subprocesses started by this process from now on, every ffmpeg reader and writer is one. Processes
+    of the segment render pool are not included.
+    """
+    counter = {"count": 0}
+    popen = subprocess.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *args, **kwargs):
+            counter["count"] += 1
+            super().__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    return counter
+
+
+def _drain_events(events, stage_ends):
+    # The end of a stage is its last progress event, the final event of a stage is never throttled.
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        if event["current"] >= event["total"]:
+            stage_ends[event["stage"]] = time.perf_counter()
+
+
+def serve_materials(material_dir):
+    handler = functools.partial(_QuietHandler, directory=material_dir)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def compare(results, baseline):
+    """
+    Print the change of every workload against a baseline run.
+    """
+    baseline_workloads = {workload["name"]: workload for workload in baseline["workloads"]}
+    print(f"{'workload':<28}{'wall_time':>22}{'frames/s':>20}{'peak_rss_mb':>24}", file=sys.stderr)
+    for workload in results["workloads"]:
+        base = baseline_workloads.get(workload["name"])
+        if base is None:
+            continue
+        columns = [_change(base[key], workload[key]) for key in ("wall_time", "frames_per_second", "peak_rss_mb")]
+        print(f"{workload['name']:<28}{columns[0]:>22}{columns[1]:>20}{columns[2]:>24}", file=sys.stderr)
+
+
+def _change(before, after):
+    percent = (after - before) / before * 100 if before else 0
+    return f"{before} -> {after} ({percent:+.1f}%)"
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the compile_video pipeline on synthetic materials.")
+    parser.add_argument("--shots", default="1,10,50", help="comma separated shot counts")
+    parser.add_argument("--orientations", default="landscape,portrait")
+    parser.add_argument("--captions", default="v1,v2", help="caption formats, v1 (caption) and/or v2 (captions)")
+    parser.add_argument("--resolution", default="1920x1080", help="landscape size of the materials")
+    parser.add_argument("--shot-duration", type=float, default=3, help="narration seconds per shot")
+    parser.add_argument("--profile", default=None, help="encoder profile of the renders")
+    parser.add_argument("--segmented", action="store_true", help="render shots to segments in parallel")
+    parser.add_argument("--preview", action="store_true", help="render previews from proxies")
+    parser.add_argument("--engine", default=None, help="render engine, defaults to RENDER_ENGINE")
+    parser.add_argument("--material-dir", default=DEFAULT_MATERIAL_DIR)
+    parser.add_argument("--font", default=None, help="caption font, defaults to CAPTION_FONT")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file instead of stdout")
+    parser.add_argument("--compare", default=None, help="baseline JSON of an earlier run to compare against")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", stream=sys.stderr)
+
+    from config.common_config import CAPTION_FONT
+    import moviepy
+
+    width, height = (int(value) for value in args.resolution.split("x"))
+    material_dir = os.path.abspath(os.path.join(args.material_dir, f"{width}x{height}_{args.shot_duration:g}s"))
+    logger.info("generate materials, dir: %s", material_dir)
+    generate_materials(material_dir, width, height, args.shot_duration)
+    server = serve_materials(material_dir)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    font_path = os.path.abspath(args.font or CAPTION_FONT)
+
+    results = {
+        "commit": get_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "moviepy": moviepy.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "resolution": args.resolution,
+        "shot_duration": args.shot_duration,
+        "profile": args.profile,
+        "segmented": args.segmented,
+        "preview": args.preview,
+        "engine": args.engine,
+        "workloads": [],
+    }
+    try:
+        for shots in (int(value) for value in args.shots.split(",")):
+            for orientation in args.orientations.split(","):
+                for captions in args.captions.split(","):
+                    name = f"{shots}shots_{orientation}_{captions}"
+                    param = build_param(base_url, shots, orientation, captions, args.shot_duration, args.profile,
+                                        args.segmented, args.preview, args.engine)
+                    # A fresh process per workload, nothing is cached between workloads.
+                    with ProcessPoolExecutor(max_workers=1,
+                                             mp_context=multiprocessing.get_context("spawn")) as executor:
+                        workload = executor.submit(run_workload, name, param, font_path).result()
+                    logger.info("workload %s: %ss, %s frames/s, peak rss %s MB", name, workload["wall_time"],
+                                workload["frames_per_second"], workload["peak_rss_mb"])
+                    results["workloads"].append(workload)
+    finally:
+        server.shutdown()
+
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
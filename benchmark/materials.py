@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+from PIL import Image
+from moviepy import VideoClip
+from moviepy.audio.AudioClip import AudioArrayClip
+
+AUDIO_FPS = 44100
+BGM_DURATION = 20
+
+CAPTIONS_EN = [
+    "The quick brown fox jumps over the lazy dog. Then it runs into the forest and disappears!",
+    "Synthetic benchmark caption, long enough to wrap onto a second line of the frame.",
+]
+CAPTIONS_CJK = [
+    "今天的天气非常好，我们一起去公园散步吧。公园里有很多花，非常漂亮！",
+    "这是一个用于性能测试的字幕，长度足够在画面上换行显示。",
+]
+
+
+def generate_materials(material_dir, width, height, shot_duration):
+    """
+    Write the synthetic materials of the benchmark into ``material_dir``: a looping bgm, narration tones, solid and
+    noise images and short test videos, each image and video in landscape and portrait. Existing files are kept.
+    """
+    os.makedirs(material_dir, exist_ok=True)
+    write_tone(os.path.join(material_dir, "bgm.mp3"), BGM_DURATION, [220, 330])
+    write_tone(os.path.join(material_dir, "narration.mp3"), shot_duration, [440])
+    for orientation, size in (("landscape", (width, height)), ("portrait", (height, width))):
+        write_image(os.path.join(material_dir, f"solid_{orientation}.png"), size, noise=False)
+        write_image(os.path.join(material_dir, f"noise_{orientation}.png"), size, noise=True)
+        write_video(os.path.join(material_dir, f"video_{orientation}.mp4"), size, shot_duration / 2)
+
+
+def write_tone(path, duration, frequencies):
+    if os.path.exists(path):
+        return
+    t = np.arange(int(duration * AUDIO_FPS)) / AUDIO_FPS
+    tone = sum(np.sin(2 * np.pi * frequency * t) for frequency in frequencies) * 0.3 / len(frequencies)
+    AudioArrayClip(np.stack([tone, tone], axis=1), fps=AUDIO_FPS).write_audiofile(path, logger=None)
+
+
+def write_image(path, size, noise):
+    if os.path.exists(path):
+        return
+    width, height = size
+    if noise:
+        pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    else:
+        pixels = np.full((height, width, 3), (40, 90, 160), dtype=np.uint8)
+    Image.fromarray(pixels).save(path)
+
+
+def write_video(path, size, duration):
+    if os.path.exists(path):
+        return
+    width, height = size
+    x = np.arange(width, dtype=np.float32)[None, :]
+    y = np.arange(height, dtype=np.float32)[:, None]
+
+    def frame_function(t):
+        # A moving gradient, every frame differs.
+        shift = t * 200
+        red = (x + shift) % 256 + y * 0
+        green = (y + shift) % 256 + x * 0
+        blue = (x + y + shift) % 256
+        return np.stack([red, green, blue], axis=2).astype(np.uint8)
+
+    VideoClip(frame_function, duration=duration).write_videofile(path, fps=16, codec="libx264", audio=False,
+                                                                logger=None)
@@ -1,3 +1,124 @@
+import os
+
 FILE_DIR = "./tmp/"
 CAPTION_FONT = "NotoSansSC.ttf"
 # "Microsoft-YaHei-Bold-&-Microsoft-YaHei-UI-Bold"
+
+# job scheduler: renders are CPU-bound and run in worker processes, resizes are I/O-bound and run in threads.
+RENDER_WORKERS = os.cpu_count() or 1
+RESIZE_WORKERS = 8
+# Maximum number of accepted but unfinished jobs, in total and per websocket connection, and of jobs of a connection
+# waiting for room in the queue, beyond which its jobs are refused.
+JOB_QUEUE_SIZE = 64
+JOB_QUEUE_SIZE_PER_CONNECTION = 8
+JOB_SUBMIT_BACKLOG_PER_CONNECTION = 64
+
+# job queue: "local" runs the jobs in the worker pools of the server, "broker" queues them on JOB_BROKER_URL for job
+# workers (python -m service.job_worker) on any node sharing FILE_DIR and the data directory with the server. The server
+# polls the broker every JOB_BROKER_POLL_INTERVAL seconds for progress and results, a running job whose worker sent no
+# heartbeat for JOB_BROKER_LEASE seconds is queued again, and finished jobs are purged after JOB_BROKER_RETENTION.
+JOB_QUEUE_BACKEND = "local"
+JOB_BROKER_URL = "sqlite:///./tmp/data/omni-editor/broker.db"
+JOB_BROKER_POLL_INTERVAL = 0.2
+JOB_BROKER_LEASE = 30
+JOB_BROKER_RETENTION = 24 * 3600
+
+# material download: concurrent downloads per task, (connect, read) timeout in seconds, retries with exponential backoff.
+DOWNLOAD_WORKERS_PER_TASK = 8
+DOWNLOAD_POOL_SIZE = 32
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# material cache shared by all tasks: byte budget with LRU eviction, and how long an entry is served without
+# revalidating it against the origin.
+MATERIAL_CACHE_DIR = "./tmp/data/omni-editor/cache/"
+MATERIAL_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+MATERIAL_CACHE_FRESH_SECONDS = 300
+
+# scratch directory the materials of a job are linked into, named after its task and removed once the job is done.
+TASK_MATERIAL_DIR = "./tmp/data/omni-editor/download/{task_id}/"
+
+# segment render: shots are rendered to intermediate segments in parallel and joined with a stream-copy concat. A job
+# runs a pool of up to SEGMENT_RENDER_WORKERS processes, as many as the cores of its own and the idle render slots.
+SEGMENT_RENDER = False
+SEGMENT_RENDER_WORKERS = os.cpu_count() or 1
+SEGMENT_DIR = "./tmp/data/omni-editor/segment/{task_id}/"
+
+# render cache: index of finished outputs by the hash of their compile_video param, and per-shot segments.
+RENDER_CACHE_DIR = "./tmp/data/omni-editor/render/"
+RENDER_CACHE_MAX_SEGMENT_BYTES = 20 * 1024 * 1024 * 1024
+
+# encoder profiles selectable per compile_video request, resolution_cap caps the shorter side of the output.
+ENCODER_PROFILE = "standard"
+ENCODER_PROFILES = {
+    "draft": {"fps": 12, "preset": "ultrafast", "crf": 30, "resolution_cap": 720, "audio_bitrate": "96k"},
+    "standard": {"fps": 16, "preset": "medium", "crf": 23},
+    "archive": {"fps": 16, "preset": "slow", "crf": 20, "audio_bitrate": "192k"},
+}
+
+# preview renders: materials are downscaled once to proxies, with the shorter side of the canvas at
+# PREVIEW_RESOLUTION, and the preview is encoded with PREVIEW_PROFILE. Proxies are cached by material content in
+# PROXY_CACHE_DIR with LRU eviction beyond PROXY_CACHE_MAX_BYTES, and generated PROXY_WORKERS at a time.
+PREVIEW_RESOLUTION = 360
+PREVIEW_PROFILE = {"fps": 8, "preset": "ultrafast", "crf": 30, "audio_bitrate": "64k"}
+PROXY_CACHE_DIR = "./tmp/data/omni-editor/proxy/"
+PROXY_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024
+PROXY_WORKERS = os.cpu_count() or 1
+
+# render engines selectable per compile_video request: "moviepy" composes the frames in Python, "ffmpeg" compiles the
+# render into a single ffmpeg filtergraph.
+RENDER_ENGINE = "moviepy"
+RENDER_ENGINES = ("moviepy", "ffmpeg")
+
+# frames rendered ahead of the encoder: frames are produced into a ring of FRAME_RING_SIZE preallocated buffers while
+# the encoder takes the previous ones.
+FRAME_RING_SIZE = 8
+
+# file readers (ffmpeg subprocesses) a render keeps open, the least recently read ones are released beyond it and
+# reopened when they are read again.
+MAX_OPEN_READERS = 16
+
+# number of rasterized caption images kept per render process.
+CAPTION_SPRITE_CACHE_SIZE = 256
+
+# output downloads: concurrent transfers before answering 503, read size of a streamed transfer, and whether to hand
+# transfers to a front server with X-Sendfile.
+DOWNLOAD_MAX_CONCURRENCY = 64
+DOWNLOAD_STREAM_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_X_SENDFILE = False
+
+# image resize: images of a batch processed in parallel, selectable output formats with their default quality.
+IMG_RESIZE_WORKERS = os.cpu_count() or 1
+IMG_FORMATS = ("JPEG", "PNG", "WEBP")
+IMG_QUALITY = {"JPEG": 90, "WEBP": 85}
+IMG_PNG_COMPRESS_LEVEL = 6
+
+# x264 settings for outputs and segments made only of still pictures: there is no motion to search, the frames
+# after the first of a run are encoded as skips.
+STILL_X264_PARAMS = "me=dia:subme=2:rc-lookahead=10"
+
+# metrics: every process writes its samples to its own file in METRICS_DIR, merged by the /metrics route.
+METRICS_DIR = "./tmp/data/omni-editor/metrics/"
+METRICS_FLUSH_INTERVAL = 1
+
+# logging: rotated log file, "text" or "json" lines, and payloads (messages, params, results) capped at
+# LOG_PAYLOAD_MAX_CHARS and logged for LOG_PAYLOAD_SAMPLE_RATE of the requests, errors always log them. Every job worker
+# rotates a log file of its own, worker processes log through the server or job worker that started them.
+LOG_FILE = "app.log"
+JOB_WORKER_LOG_FILE = "job_worker.{pid}.log"
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+LOG_FORMAT = "text"
+LOG_PAYLOAD_MAX_CHARS = 2000
+LOG_PAYLOAD_SAMPLE_RATE = 1.0
+
+# storage janitor: outputs in FILE_DIR are sharded into OUTPUT_SHARD_DEPTH levels of two hex characters, kept for
+# OUTPUT_TTL seconds and evicted oldest first beyond OUTPUT_MAX_BYTES. Scratch files and task directories left behind by
+# crashed renders are removed after SCRATCH_TTL seconds. The janitor sweeps every STORAGE_JANITOR_INTERVAL seconds.
+OUTPUT_SHARD_DEPTH = 2
+OUTPUT_TTL = 7 * 24 * 3600
+OUTPUT_MAX_BYTES = 100 * 1024 * 1024 * 1024
+SCRATCH_TTL = 24 * 3600
+STORAGE_JANITOR_INTERVAL = 600
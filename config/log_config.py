@@ -1,24 +1,38 @@
+import atexit
+import copy
 import logging.config
+import multiprocessing
+import queue
+from logging.handlers import QueueListener
+
+from config.common_config import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_FORMAT
+from utils.log_utils import DeferredQueueHandler, ProcessQueueHandler
 
 LOGGING_CONFIG = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'standard': {
+        'text': {
             'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
         },
+        'json': {
+            '()': 'utils.log_utils.JsonFormatter',
+        },
     },
     'handlers': {
         'console': {
             'level': 'INFO',
             'class': 'logging.StreamHandler',
-            'formatter': 'standard',
+            'formatter': LOG_FORMAT,
         },
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': 'app.log',
-            'formatter': 'standard',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOG_FILE,
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
+            'encoding': 'utf-8',
+            'formatter': LOG_FORMAT,
         },
     },
     'loggers': {
@@ -31,5 +45,54 @@ LOGGING_CONFIG = {
 }
 
 
-def init():
-    logging.config.dictConfig(LOGGING_CONFIG)
+# Queue the worker processes send their records to, to the process owning the log file.
+_worker_queue = None
+
+
+def init(log_file=LOG_FILE):
+    """
+    Configure the logging of the process owning ``log_file``, the server or a job worker. The file is rotated by this
+    process only, the processes it starts log through it with ``init_worker(worker_queue())``.
+    """
+    global _worker_queue
+    config = copy.deepcopy(LOGGING_CONFIG)
+    config['handlers']['file']['filename'] = log_file
+    logging.config.dictConfig(config)
+    # Loggers only put records on a queue, unformatted, a listener thread does the formatting (payloads and
+    # tracebacks included) and the console and file I/O, so logging never blocks the event loop or the request
+    # threads on serialization or disk writes.
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    # Records of the worker processes, the handlers are thread-safe.
+    _worker_queue = multiprocessing.get_context("spawn").Queue()
+    worker_listener = QueueListener(_worker_queue, *handlers, respect_handler_level=True)
+    worker_listener.start()
+    atexit.register(worker_listener.stop)
+
+
+def init_worker(log_queue):
+    """
+    Pool initializer of worker processes: their records are sent to the process that started them, through
+    ``log_queue``, and passed on to the pools they start themselves.
+    """
+    global _worker_queue
+    _worker_queue = log_queue
+    if log_queue is None:
+        # Started by a process that did not configure logging.
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(ProcessQueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+
+def worker_queue():
+    return _worker_queue
@@ -1,20 +1,47 @@
+import hashlib
+import json
 import logging
-from typing import List, Dict, Optional
-
-from moviepy import VideoFileClip, AudioFileClip, TextClip, CompositeVideoClip, concatenate_videoclips, afx, \
-    CompositeAudioClip, concatenate_audioclips
-from pydantic import BaseModel
-
-from config.common_config import FILE_DIR, CAPTION_FONT
-from utils.audio_utils import extend_audio, generate_silent_audio
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import List, Dict, Optional, Tuple
+
+from moviepy import CompositeVideoClip, concatenate_videoclips
+from pydantic import BaseModel, field_validator
+
+from config import log_config
+from config.common_config import CAPTION_FONT, SEGMENT_RENDER, SEGMENT_RENDER_WORKERS, SEGMENT_DIR, \
+    ENCODER_PROFILE, ENCODER_PROFILES, STILL_X264_PARAMS, PREVIEW_RESOLUTION, PREVIEW_PROFILE, PROXY_WORKERS, \
+    RENDER_ENGINE, RENDER_ENGINES, RENDER_CACHE_DIR, TASK_MATERIAL_DIR
+from utils import metrics
+from utils.audio_utils import AudioTimeline
+from utils.caption_overlay import CaptionOverlay
+from utils.caption_layout import get_glyph_metrics
+from utils.caption_renderer import render_caption
 from utils.caption_utils import split_caption, add_newlines, split_text_display
 from utils.clips_manager import clean_clips
-from utils.file_downloader import download
+from utils.ffmpeg_utils import concat_segments
+from utils.file_downloader import download_all, get_content_hash
+from utils.filtergraph import Filtergraph, FiltergraphShot
+from utils.frame_writer import write_clip, AUDIO_FPS
 from utils.img_utils import gen_video_with_img
-from utils.video_utils import extend_video_with_first_frame
+from utils.job_context import JobContext, JobCancelled
+from utils.log_utils import payload
+from utils.media_probe import probe, probe_image
+from utils.proxy_cache import get_proxy_cache
+from utils.render_cache import get_render_cache
+from utils.storage import output_path, output_tmp_path, new_scratch_name, remove_task_materials
+from utils.video_utils import extend_video_with_first_frame, StillRuns, reuse_still_frames
 
 logger = logging.getLogger(__name__)
 
+BGM_VOLUME = 0.2
+# Part of every render cache key, bump it whenever a change alters the rendered output.
+RENDER_VERSION = 7
+
 
 class CaptionItem(BaseModel):
     text: str
@@ -41,66 +68,201 @@ class Shot(BaseModel):
     video: Optional[str] = None
 
 
+class EncoderProfile(BaseModel):
+    fps: int = 16
+    # x264 preset, quality (crf) or target bitrate, and encoder threads (None lets x264 decide).
+    preset: str = "medium"
+    crf: Optional[int] = None
+    bitrate: Optional[str] = None
+    threads: Optional[int] = None
+    # Cap of the shorter side of the output, e.g. 720 for 720p.
+    resolution_cap: Optional[int] = None
+    audio_bitrate: Optional[str] = None
+    faststart: bool = True
+
+    @staticmethod
+    def get(name: Optional[str]) -> "EncoderProfile":
+        return EncoderProfile.model_validate(ENCODER_PROFILES[name or ENCODER_PROFILE])
+
+
 class CompileVideoParam(BaseModel):
     bgm: str
     shots: List[Shot]
+    # Render every shot to its own segment in parallel, defaults to SEGMENT_RENDER.
+    segmented: Optional[bool] = None
+    # Name of an encoder profile in ENCODER_PROFILES, defaults to ENCODER_PROFILE.
+    profile: Optional[str] = None
+    # Render a low resolution preview with PREVIEW_PROFILE, instead of the profile.
+    preview: bool = False
+    # Render engine in RENDER_ENGINES, defaults to RENDER_ENGINE.
+    engine: Optional[str] = None
+
+    @field_validator("profile")
+    @classmethod
+    def check_profile(cls, profile):
+        if profile is not None and profile not in ENCODER_PROFILES:
+            raise ValueError(f"unknown encoder profile: {profile}")
+        return profile
+
+    @field_validator("engine")
+    @classmethod
+    def check_engine(cls, engine):
+        if engine is not None and engine not in RENDER_ENGINES:
+            raise ValueError(f"unknown render engine: {engine}")
+        return engine
 
 
 class ShotMaterial(BaseModel):
     audio: str = None
     img: str = None
     video: str = None
+    # Size of the canvas the captions are laid out on, and duration of the original video, set by the normalization.
+    layout_size: Optional[Tuple[int, int]] = None
+    video_duration: Optional[float] = None
 
 
 class CompileVideoMaterial(BaseModel):
     bgm: str = None
     shot: Dict[int, ShotMaterial] = {}
+    # local file path -> sha256 of its content
+    hashes: Dict[str, str] = {}
+    # Scale of the output to the canvas of the original materials, 1 for a full resolution render.
+    scale: float = 1
 
 
 class CompileVideoService:
     @staticmethod
-    def compile_video(task_id: str, param: CompileVideoParam) -> dict:
+    def compile_video(task_id: str, param: CompileVideoParam, context: Optional[JobContext] = None) -> dict:
         if not param.shots:
             return {}
+        context = context or JobContext(task_id)
+        scratch_name = new_scratch_name(task_id)
         try:
-            material = CompileVideoService.download_materials(param, task_id)
-            video_name = CompileVideoService.compile_video_with_material(param, task_id, material)
+            material = CompileVideoService.download_materials(param, scratch_name, context)
+            render_key = CompileVideoService.get_render_key(param, material)
+            render_cache = get_render_cache()
+            video_name = CompileVideoService.get_video_name(task_id, param)
+            if render_cache.get_output(render_key, video_name):
+                logger.info("compile_video cache hit, task_id: %s, video: %s", task_id, video_name)
+                return {"video": video_name}
+            material = CompileVideoService.normalize_materials(param, material, scratch_name, context)
+            # Rendered under the name of its render key, a later render of the task cannot overwrite it.
+            CompileVideoService.compile_video_with_material(param, scratch_name,
+                                                            render_cache.output_name(render_key), material, context)
+            if not render_cache.link_output(render_key, video_name):
+                raise FileNotFoundError(f"output removed before it was linked: {video_name}")
             logger.info("compile_video success, task_id: %s, video: %s", task_id, video_name)
             return {"video": video_name}
+        except JobCancelled as e:
+            logger.info("compile_video cancelled, task_id: %s", task_id)
+            raise e
         except Exception as e:
-            logger.error("compile_video fail, param: %s, error: %s", param, e, exc_info=True)
+            logger.error("compile_video fail, param: %s, error: %s", payload(param, sample=False), e, exc_info=True)
             raise e
+        finally:
+            # The materials are linked from the material cache, only the links of the job are removed.
+            remove_task_materials(scratch_name)
+            metrics.flush()
+
+    @staticmethod
+    def get_render_key(param, material) -> str:
+        # Materials are identified by content, so the same payload with another task_id or re-uploaded materials
+        # maps to the same key.
+        return CompileVideoService.hash_key({
+            "version": RENDER_VERSION,
+            "profile": CompileVideoService.get_profile(param).model_dump(),
+            "preview": PREVIEW_RESOLUTION if param.preview else None,
+            "engine": param.engine or RENDER_ENGINE,
+            "bgm": material.hashes[material.bgm],
+            "shots": [CompileVideoService.get_shot_key_payload(index, shot, material)
+                      for index, shot in enumerate(param.shots)],
+        })
+
+    @staticmethod
+    def get_segment_key(index, shot, material, size, profile) -> str:
+        return CompileVideoService.hash_key({
+            "version": RENDER_VERSION,
+            "profile": profile.model_dump(),
+            "size": list(size),
+            # The canvas the captions are laid out on, and their scale to the segment.
+            "layout": [material.shot[index].layout_size, material.scale],
+            "shot": CompileVideoService.get_shot_key_payload(index, shot, material),
+        })
+
+    @staticmethod
+    def get_shot_key_payload(index, shot, material) -> dict:
+        shot_material = material.shot[index]
+        captions = None
+        if shot.captions:
+            captions = {"type": shot.captions.type,
+                        "items": [[item.text, item.startTime, item.endTime] for item in shot.captions.items]}
+        return {
+            # The opening shot is padded by 1 second.
+            "opening": index == 0,
+            "caption": shot.caption,
+            "captions": captions,
+            "audio": material.hashes.get(shot_material.audio),
+            "img": material.hashes.get(shot_material.img),
+            "video": material.hashes.get(shot_material.video),
+        }
 
     @staticmethod
-    def compile_shot_videos(clip_cleaner, param, material):
+    def hash_key(payload) -> str:
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def compile_shot_videos(clip_cleaner, param, material, context):
         video_clips = []
+        still_runs = []
         for index, shot in enumerate(param.shots):
-            # process video
-            video_clip = CompileVideoService.get_shot_video_clip(clip_cleaner, index, shot, material)
-            # assemble video
-            video_clip = CompileVideoService.assemble_shot_audio(clip_cleaner, index, material, shot, video_clip)
-            # assemble caption
-            if shot.captions:
-                video_clip = CompileVideoService.assemble_caption_v2(clip_cleaner, video_clip, shot.captions)
-            else:
-                video_clip = CompileVideoService.assemble_caption(clip_cleaner, video_clip, shot.caption)
+            context.check_cancelled()
+            video_clip, shot_still_runs = CompileVideoService.compile_shot_video(clip_cleaner, index, shot, material)
             video_clips.append(video_clip)
-        return video_clips
+            still_runs.append(shot_still_runs)
+            context.report("compose", index + 1, len(param.shots))
+        return video_clips, still_runs
+
+    @staticmethod
+    def compile_shot_video(clip_cleaner, index, shot, material):
+        """
+        The clip of the shot, and its still runs: the whole shot for an image, the extended first frame for a video.
+        """
+        # process video
+        video_clip = CompileVideoService.get_shot_video_clip(clip_cleaner, index, shot, material)
+        if shot.video:
+            origin_video_clip = CompileVideoService.open_shot_video(clip_cleaner, index, shot, material)
+            still_duration = video_clip.duration - origin_video_clip.duration
+        else:
+            still_duration = video_clip.duration
+        # assemble video
+        video_clip = CompileVideoService.assemble_shot_audio(clip_cleaner, index, material, shot, video_clip)
+        # assemble caption
+        captions_overlay = CaptionOverlay(material.scale, material.shot[index].layout_size)
+        if shot.captions:
+            CompileVideoService.assemble_caption_v2(captions_overlay, video_clip.size, video_clip.duration,
+                                                    shot.captions)
+        else:
+            CompileVideoService.assemble_caption(captions_overlay, video_clip.size, video_clip.duration, shot.caption)
+        video_clip = clip_cleaner(captions_overlay.apply(video_clip))
+        return video_clip, StillRuns([(0, still_duration)], captions_overlay.boundaries())
 
     @staticmethod
+    @metrics.timed("open_shot")
     def get_shot_video_clip(clip_cleaner, index, shot, material):
+        shot_material = material.shot[index]
         # If the video does not exist, convert the image to video.
         if not shot.video:
-            audio_clip = clip_cleaner(AudioFileClip(material.shot[index].audio))
-            video_clip = clip_cleaner(gen_video_with_img(material.shot[index].img, audio_clip.duration))
+            audio_duration = probe(shot_material.audio).duration
+            video_clip = clip_cleaner(gen_video_with_img(shot_material.img, audio_duration))
         else:
-            video_clip = clip_cleaner(VideoFileClip(material.shot[index].video))
+            video_clip = CompileVideoService.open_shot_video(clip_cleaner, index, shot, material)
 
         # If the audio is longer than the video, extend the first frame of the video.
         if shot.audio and shot.video:
-            audio_clip = clip_cleaner(AudioFileClip(material.shot[index].audio))
-            if audio_clip.duration > video_clip.duration:
-                extend_duration = audio_clip.duration - video_clip.duration
+            audio_duration = probe(shot_material.audio).duration
+            if audio_duration > video_clip.duration:
+                extend_duration = audio_duration - video_clip.duration
                 video_clip = clip_cleaner(extend_video_with_first_frame(video_clip, extend_duration))
 
         # If it is the opening, add 1 second.
@@ -110,143 +272,477 @@ class CompileVideoService:
         return video_clip
 
     @staticmethod
-    def compile_video_with_material(param, task_id, material) -> str:
+    def open_shot_video(clip_cleaner, index, shot, material):
+        shot_material = material.shot[index]
+        # The own audio of the video is only used if the shot has no audio.
+        video_clip = clip_cleaner.open_video(shot_material.video, audio=not shot.audio)
+        # A normalized video keeps the duration of the original, resampling may have rounded it to whole frames.
+        if shot_material.video_duration is not None and shot_material.video_duration != video_clip.duration:
+            video_clip = clip_cleaner(video_clip.with_duration(shot_material.video_duration))
+        return video_clip
+
+    @staticmethod
+    def compile_video_with_material(param, scratch_name, video_name, material, context) -> str:
+        if (param.engine or RENDER_ENGINE) == "ffmpeg":
+            return CompileVideoService.compile_video_with_ffmpeg(param, video_name, material, context)
+        segmented = SEGMENT_RENDER if param.segmented is None else param.segmented
+        if segmented and len(param.shots) > 1:
+            return CompileVideoService.compile_video_with_segments(param, scratch_name, video_name, material, context)
         with clean_clips() as clip_cleaner:
-            shot_video_clips = CompileVideoService.compile_shot_videos(clip_cleaner, param, material)
-            mix_shots_video = clip_cleaner(concatenate_videoclips(shot_video_clips))
-            mix_bgm_video = CompileVideoService.assemble_bmg(clip_cleaner, mix_shots_video, material.bgm)
-            video_name = CompileVideoService.write_video_file(task_id, mix_bgm_video)
+            shot_video_clips, shot_still_runs = CompileVideoService.compile_shot_videos(clip_cleaner, param, material,
+                                                                                         context)
+            mix_bgm_video = CompileVideoService.assemble_audio(clip_cleaner, shot_video_clips, material.bgm)
+            profile = CompileVideoService.get_profile(param)
+            mix_bgm_video = CompileVideoService.cap_resolution(clip_cleaner, mix_bgm_video, profile)
+            # Still frames are composed, captioned and scaled once per run.
+            still_runs = StillRuns.concatenate(shot_still_runs, [clip.duration for clip in shot_video_clips])
+            mix_bgm_video = clip_cleaner(reuse_still_frames(mix_bgm_video, still_runs))
+            still = all(not shot.video for shot in param.shots)
+            CompileVideoService.write_video_file(video_name, mix_bgm_video, profile, context, still)
+            return video_name
+
+    @staticmethod
+    def compile_video_with_segments(param, scratch_name, video_name, material, context) -> str:
+        segment_dir = SEGMENT_DIR.format(task_id=scratch_name)
+        os.makedirs(segment_dir, exist_ok=True)
+        size = CompileVideoService.get_canvas_size(param, material)
+        profile = CompileVideoService.get_profile(param)
+        try:
+            workers = min(SEGMENT_RENDER_WORKERS, len(param.shots), context.cores or SEGMENT_RENDER_WORKERS)
+            # Segment processes log through the process owning the log file, like the render process.
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=log_config.init_worker,
+                                     initargs=(log_config.worker_queue(),)) as executor:
+                futures = [executor.submit(CompileVideoService.render_shot_segment, index, shot, material, size,
+                                           profile, os.path.join(segment_dir, f"{index}.mov"), context)
+                           for index, shot in enumerate(param.shots)]
+                try:
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        future.result()
+                        context.report("compose", done, len(futures))
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+                segment_paths = [future.result() for future in futures]
+            context.check_cancelled()
+            tmp_path = output_tmp_path(video_name)
+            try:
+                with metrics.span("concat") as span:
+                    concat_segments(segment_paths, tmp_path, material.bgm, BGM_VOLUME,
+                                    audio_bitrate=profile.audio_bitrate, faststart=profile.faststart)
+                    span.add(bytes=os.path.getsize(tmp_path))
+                os.replace(tmp_path, output_path(video_name))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
             return video_name
+        finally:
+            shutil.rmtree(segment_dir, ignore_errors=True)
 
     @staticmethod
-    def write_video_file(task_id, video) -> str:
-        video_name = task_id + ".mp4"
-        video_path = FILE_DIR + video_name
-        video.write_videofile(video_path, fps=16, codec="libx264", audio_codec="aac")
+    def render_shot_segment(index, shot, material, size, profile, segment_path, context) -> str:
+        # Unchanged shots are reused from the render cache, so editing one shot only re-renders that shot.
+        render_cache = get_render_cache()
+        segment_key = CompileVideoService.get_segment_key(index, shot, material, size, profile)
+        cached_segment_path = render_cache.get_segment(segment_key)
+        if cached_segment_path is not None:
+            try:
+                # Link the segment into the job, so a concurrent eviction cannot remove it before the concat.
+                os.link(cached_segment_path, segment_path)
+            except FileNotFoundError:
+                # Evicted since the lookup.
+                cached_segment_path = None
+        if cached_segment_path is None:
+            tmp_path = render_cache.new_temp_path(".mov")
+            try:
+                CompileVideoService.write_shot_segment(index, shot, material, size, profile, tmp_path, context)
+                # Linked before it is put into the cache, where it may be evicted at once.
+                os.link(tmp_path, segment_path)
+                render_cache.put_segment(segment_key, tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        # Segments render in pool processes, publish their metrics before the process idles.
+        metrics.flush()
+        return segment_path
+
+    @staticmethod
+    @metrics.timed("segment_encode")
+    def write_shot_segment(index, shot, material, size, profile, segment_path, context):
+        with clean_clips() as clip_cleaner:
+            video_clip, still_runs = CompileVideoService.compile_shot_video(clip_cleaner, index, shot, material)
+            # Segments are joined without re-encoding, so they must all have the same size. Every shot has an audio
+            # track, silent if it has no audio.
+            if tuple(video_clip.size) != tuple(size):
+                video_clip = clip_cleaner(CompositeVideoClip([video_clip.with_position("center")], size=size))
+            video_clip = CompileVideoService.cap_resolution(clip_cleaner, video_clip, profile)
+            video_clip = clip_cleaner(reuse_still_frames(video_clip, still_runs))
+            # Segments end on a frame boundary with both tracks of the same length: the concat places a segment at
+            # the end of the longest track of the previous one, a longer audio track would leave a gap in the video.
+            # The segment is padded to whole frames, all of them still sampled within the shot, and its audio to the
+            # same length with silence. The half frame keeps the frame count from rounding down.
+            frames = math.ceil(round(video_clip.duration * profile.fps, 6))
+            audio = video_clip.audio.with_duration((frames * AUDIO_FPS // profile.fps + 0.5) / AUDIO_FPS)
+            video_clip = clip_cleaner(video_clip.with_duration((frames + 0.5) / profile.fps).with_audio(audio))
+            # Uncompressed audio keeps the segments sample accurate, it is encoded once when the bgm is mixed in.
+            write_clip(video_clip, segment_path, audio_codec="pcm_s16le", logger=context.progress_logger(None),
+                       audio_logger=context.progress_logger(None),
+                       **CompileVideoService.get_video_write_params(profile, still=not shot.video))
+
+    @staticmethod
+    def compile_video_with_ffmpeg(param, video_name, material, context) -> str:
+        """
+        Render with the ffmpeg engine: the shots are planned from the probed durations, with the same timing and
+        caption layout as the moviepy engine, and rendered by a single ffmpeg filtergraph.
+        """
+        profile = CompileVideoService.get_profile(param)
+        size = CompileVideoService.get_canvas_size(param, material)
+        shots = []
+        for index, shot in enumerate(param.shots):
+            context.check_cancelled()
+            shots.append(CompileVideoService.plan_shot(index, shot, material))
+            context.report("compose", index + 1, len(param.shots))
+        tmp_path = output_tmp_path(video_name)
+        still = all(not shot.video for shot in param.shots)
+        # Caption images, removed by the storage janitor if the render dies.
+        scratch_dir = tempfile.mkdtemp(dir=os.path.join(RENDER_CACHE_DIR, "tmp"))
+
+        def on_progress(frame, total):
+            context.check_cancelled()
+            context.report("encode", frame, total)
+
+        try:
+            with metrics.span("encode") as span:
+                graph = Filtergraph(shots, material.bgm, BGM_VOLUME, size, profile.fps, scratch_dir)
+                frames = graph.render(tmp_path, CompileVideoService.get_ffmpeg_output_args(profile, still),
+                                      CompileVideoService.get_capped_size(size, profile.resolution_cap), on_progress)
+                span.add(bytes=os.path.getsize(tmp_path), frames=frames)
+            os.replace(tmp_path, output_path(video_name))
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
         return video_name
 
     @staticmethod
-    def assemble_bmg(clip_cleaner, video, bgm):
-        bgm_clip = clip_cleaner(AudioFileClip(bgm))
-        bgm_clip = clip_cleaner(bgm_clip.with_volume_scaled(0.2))
-        if bgm_clip.duration >= video.duration:
-            bgm_clip = clip_cleaner(bgm_clip.with_duration(video.duration))
+    def plan_shot(index, shot, material) -> FiltergraphShot:
+        """
+        The shot as compile_shot_video composes it: the picture with its held first frame, the audio and the captions.
+        """
+        shot_material = material.shot[index]
+        audio_duration = probe(shot_material.audio).duration if shot.audio else None
+        hold = 0
+        if shot.video:
+            video_info = probe(shot_material.video)
+            size = video_info.size
+            video_duration = shot_material.video_duration or video_info.video_duration
+            duration = video_duration
+            # If the audio is longer than the video, the first frame of the video is extended.
+            if audio_duration is not None and audio_duration > duration:
+                hold = audio_duration - duration
+                duration = audio_duration
         else:
-            bgm_clip = clip_cleaner(bgm_clip.fx(afx.audio_loop, duration=video.duration))
-        mix_bgm_audio = clip_cleaner(CompositeAudioClip([bgm_clip, video.audio]))
-        mix_bgm_video = clip_cleaner(video.with_audio(mix_bgm_audio))
-        return mix_bgm_video
+            size = probe_image(shot_material.img).size
+            duration = audio_duration
+        # The opening is extended by 1 second.
+        if index == 0:
+            hold += 1
+            duration += 1
+
+        audio = None
+        audio_start = 1 if index == 0 else 0
+        if shot.audio:
+            audio = shot_material.audio
+            # If the original video is longer than the original audio, the audio is centered.
+            if shot.video and video_duration > audio_duration:
+                audio_start += (video_duration - audio_duration) / 2
+        elif shot.video and video_info.has_audio:
+            # The own audio of the video.
+            audio = shot_material.video
+
+        captions_overlay = CaptionOverlay(material.scale, shot_material.layout_size)
+        if shot.captions:
+            CompileVideoService.assemble_caption_v2(captions_overlay, size, duration, shot.captions)
+        else:
+            CompileVideoService.assemble_caption(captions_overlay, size, duration, shot.caption)
+        return FiltergraphShot(duration, img=shot_material.img if not shot.video else None,
+                               video=shot_material.video if shot.video else None,
+                               video_fps=video_info.fps if shot.video else None, hold=hold if shot.video else 0,
+                               audio=audio, audio_start=audio_start, captions=captions_overlay.captions())
+
+    @staticmethod
+    def get_ffmpeg_output_args(profile, still=False) -> list:
+        params = CompileVideoService.get_video_write_params(
+            profile, ["-movflags", "+faststart"] if profile.faststart else [], still)
+        args = ["-c:v", params["codec"], "-preset", params["preset"], "-pix_fmt", "yuv420p"]
+        if params["bitrate"] is not None:
+            args += ["-b:v", params["bitrate"]]
+        if params["threads"] is not None:
+            args += ["-threads", str(params["threads"])]
+        args += params["ffmpeg_params"] + ["-c:a", "aac"]
+        if profile.audio_bitrate:
+            args += ["-b:a", profile.audio_bitrate]
+        return args
+
+    @staticmethod
+    def get_canvas_size(param, material):
+        # The output has the size of the first shot.
+        if param.shots[0].video:
+            return probe(material.shot[0].video).size
+        return probe_image(material.shot[0].img).size
+
+    @staticmethod
+    def write_video_file(video_name, video, profile, context, still=False) -> str:
+        video_path = output_path(video_name)
+        # Write to a temporary file, so an aborted encode never leaves a truncated output behind.
+        tmp_path = output_tmp_path(video_name)
+        try:
+            with metrics.span("encode") as span:
+                write_clip(video, tmp_path, audio_codec="aac", audio_bitrate=profile.audio_bitrate,
+                           faststart=profile.faststart, logger=context.progress_logger("encode"),
+                           audio_logger=context.progress_logger(None),
+                           **CompileVideoService.get_video_write_params(profile, still=still))
+                span.add(bytes=os.path.getsize(tmp_path), frames=int(video.duration * profile.fps))
+            os.replace(tmp_path, video_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return video_name
+
+    @staticmethod
+    def get_video_name(task_id, param) -> str:
+        return task_id + ("_preview.mp4" if param.preview else ".mp4")
+
+    @staticmethod
+    def get_profile(param) -> EncoderProfile:
+        if param.preview:
+            return EncoderProfile.model_validate(PREVIEW_PROFILE)
+        return EncoderProfile.get(param.profile)
+
+    @staticmethod
+    def get_video_write_params(profile, ffmpeg_params=None, still=False) -> dict:
+        ffmpeg_params = list(ffmpeg_params or [])
+        if profile.crf is not None and profile.bitrate is None:
+            ffmpeg_params += ["-crf", str(profile.crf)]
+        if still:
+            ffmpeg_params += ["-x264-params", STILL_X264_PARAMS]
+        return {"fps": profile.fps, "codec": "libx264", "preset": profile.preset, "bitrate": profile.bitrate,
+                "threads": profile.threads, "ffmpeg_params": ffmpeg_params}
 
     @staticmethod
+    def cap_resolution(clip_cleaner, video, profile):
+        size = CompileVideoService.get_capped_size(video.size, profile.resolution_cap)
+        if size == tuple(video.size):
+            return video
+        return clip_cleaner(video.resized(new_size=size))
+
+    @staticmethod
+    def get_capped_size(size, resolution_cap):
+        width, height = size
+        if not resolution_cap or min(width, height) <= resolution_cap:
+            return tuple(size)
+        scale = resolution_cap / min(width, height)
+        # yuv420p needs even dimensions.
+        return round(width * scale / 2) * 2, round(height * scale / 2) * 2
+
+    @staticmethod
+    @metrics.timed("mix_audio")
+    def assemble_audio(clip_cleaner, shot_video_clips, bgm):
+        """
+        Concatenate the shots and mix their audio and the looped bgm into a single track.
+        """
+        video = clip_cleaner(concatenate_videoclips([clip_cleaner(clip.without_audio()) for clip in shot_video_clips]))
+        timeline = AudioTimeline(video.duration)
+        start = 0
+        for clip in shot_video_clips:
+            timeline.extend(clip.audio.timeline, start)
+            start += clip.duration
+        CompileVideoService.assemble_bmg(clip_cleaner, timeline, bgm)
+        return clip_cleaner(video.with_audio(clip_cleaner(timeline.clip())))
+
+    @staticmethod
+    @metrics.timed("bgm")
+    def assemble_bmg(clip_cleaner, timeline, bgm):
+        bgm_clip = clip_cleaner.open_audio(bgm)
+        timeline.add(bgm_clip, volume=BGM_VOLUME, loop=True)
+
+    @staticmethod
+    @metrics.timed("shot_audio")
     def assemble_shot_audio(clip_cleaner, index, material, shot, video_clip):
-        if not shot.audio:
-            return video_clip
-        audio_clip = clip_cleaner(AudioFileClip(material.shot[index].audio))
-        # If the original video is longer than the original audio, extend the audio at both the beginning and the end.
-        if shot.video:
-            origin_video_clip = clip_cleaner(VideoFileClip(material.shot[index].video))
-            if origin_video_clip.duration > audio_clip.duration:
-                extend_duration = (origin_video_clip.duration - audio_clip.duration) / 2
-                audio_clip = clip_cleaner(extend_audio(audio_clip, extend_duration, True))
-                audio_clip = clip_cleaner(extend_audio(audio_clip, extend_duration))
-        # If it is the opening, add 1 second.
-        if index == 0:
-            extend_duration = 1
-            silence_audio = clip_cleaner(generate_silent_audio(extend_duration, audio_clip.fps, audio_clip.nchannels))
-            clips = [silence_audio, audio_clip]
-            audio_clip = clip_cleaner(concatenate_audioclips(clips))
-        video_clip = clip_cleaner(video_clip.with_audio(audio_clip))
+        """
+        Give the shot a track of its own duration. The audio of the shot is centered if the video is longer, the
+        opening shot starts after 1 second of silence, the extended first frame.
+        """
+        shot_material = material.shot[index]
+        timeline = AudioTimeline(video_clip.duration)
+        start = 1 if index == 0 else 0
+        if shot.audio:
+            audio_clip = clip_cleaner.open_audio(shot_material.audio)
+            # If the original video is longer than the original audio, pad the audio at both the beginning and the end.
+            if shot.video:
+                # The duration of the original video, a normalized video may have been rounded to whole frames.
+                origin_video_duration = shot_material.video_duration or probe(shot_material.video).video_duration
+                if origin_video_duration > audio_clip.duration:
+                    start += (origin_video_duration - audio_clip.duration) / 2
+            timeline.add(audio_clip, start)
+        elif shot.video:
+            # The own audio of the video.
+            audio_clip = clip_cleaner.open_video(shot_material.video).audio
+            if audio_clip is not None:
+                timeline.add(audio_clip, start)
+        video_clip = clip_cleaner(video_clip.with_audio(clip_cleaner(timeline.clip())))
         return video_clip
 
     @staticmethod
-    def assemble_caption(clip_cleaner, video_clip, caption):
-        captions_seg_clips = []
-        captions_seg = split_caption(caption, video_clip.duration)
-        width, height = video_clip.size
+    @metrics.timed("caption_layout")
+    def assemble_caption(captions_overlay, size, duration, caption):
+        captions_seg = split_caption(caption, duration)
+        width, height = captions_overlay.frame_size(size)
         seg_start = 0
 
         for seg_index, (seg, seg_duration) in enumerate(captions_seg):
             if height > width:
                 seg = add_newlines(seg, max_length=15)
-                captions_clip = clip_cleaner(TextClip(font=CAPTION_FONT, text=seg, font_size=40,
-                                                      text_align='center', color='white', stroke_color='black',
-                                                      method='caption', stroke_width=1, size=(width, None)))
-                captions_width, captions_height = captions_clip.size
+                captions_sprite = CompileVideoService.build_caption_sprite(seg, width)
+                captions_width, captions_height = captions_sprite.size
                 # For vertical video caption: position them halfway between the center of the screen and their
                 # current position (captions_height + 280 from the bottom).
                 captions_pos = (
                     (width - captions_width) / 2, height - height / 2 + (height / 2 - captions_height - 280) / 2)
             else:
                 seg = add_newlines(seg, max_length=38)
-                captions_clip = clip_cleaner(TextClip(font=CAPTION_FONT, text=seg, font_size=40,
-                                                      text_align='center', color='white', stroke_color='black',
-                                                      method='caption', stroke_width=1, size=(width, None)))
-                captions_width, captions_height = captions_clip.size
+                captions_sprite = CompileVideoService.build_caption_sprite(seg, width)
+                captions_width, captions_height = captions_sprite.size
                 # For horizontal video caption: position them 70 units from the bottom.
                 captions_pos = ((width - captions_width) / 2, height - captions_height - 70)
-            captions_clip = clip_cleaner(captions_clip.with_position(captions_pos))
-            captions_clip = clip_cleaner(captions_clip.with_start(seg_start))
-            captions_clip = clip_cleaner(captions_clip.with_duration(seg_duration))
-            captions_seg_clips.append(captions_clip)
+            captions_overlay.add(captions_sprite, seg_start, seg_start + seg_duration, captions_pos)
 
             seg_start += seg_duration
-        video_clip = clip_cleaner(CompositeVideoClip([video_clip, *captions_seg_clips]))
-        return video_clip
 
     @staticmethod
-    def assemble_caption_v2(clip_cleaner, video_clip, captions):
-        captions_seg_clips = []
+    @metrics.timed("caption_layout")
+    def assemble_caption_v2(captions_overlay, size, duration, captions):
         captions_segs = captions.items
-        width, height = video_clip.size
+        width, height = captions_overlay.frame_size(size)
         # For the opening, add 1 second of silence, evenly distributed before and after.
         start_head = 0.5
+        # Display lines split by the advance widths of the caption font.
+        char_size = get_glyph_metrics(CAPTION_FONT, 40).em_width
         for item in captions_segs:
             start = item.startTime / 1000 + start_head
             end = item.endTime / 1000 + start_head
-            if end > video_clip.duration:
-                end = video_clip.duration
-            time_s = end - start
+            if end > duration:
+                end = duration
 
             if height > width:
-                item.text = split_text_display(item.text, max_length=15)
-                captions_clip = clip_cleaner(TextClip(font=CAPTION_FONT, text=item.text, font_size=40,
-                                                      color='white', stroke_color='black', size=(width, None),
-                                                      method='caption', text_align='center',
-                                                      stroke_width=1))
-                captions_width, captions_height = captions_clip.size
+                text = split_text_display(item.text, max_length=15, char_size=char_size)
+                captions_sprite = CompileVideoService.build_caption_sprite(text, width)
+                captions_width, captions_height = captions_sprite.size
                 # For vertical video caption: position them halfway between the center of the screen and their
                 # current position (captions_height + 280 from the bottom).
                 captions_pos = (
                     (width - captions_width) / 2, height - height / 2 + (height / 2 - captions_height - 280) / 2)
             else:
-                item.text = split_text_display(item.text, max_length=38)
-                captions_clip = clip_cleaner(TextClip(font=CAPTION_FONT, text=item.text, font_size=40,
-                                                      color='white', stroke_color='black', size=(width, None),
-                                                      method='caption', text_align='center',
-                                                      stroke_width=1))
-                captions_width, captions_height = captions_clip.size
+                text = split_text_display(item.text, max_length=38, char_size=char_size)
+                captions_sprite = CompileVideoService.build_caption_sprite(text, width)
+                captions_width, captions_height = captions_sprite.size
                 # For horizontal video caption: position them 70 units from the bottom.
                 captions_pos = ((width - captions_width) / 2, height - captions_height - 70)
-            captions_clip = clip_cleaner(captions_clip.with_position(captions_pos))
-            captions_clip = clip_cleaner(captions_clip.with_start(start))
-            captions_clip = clip_cleaner(captions_clip.with_duration(time_s))
-            captions_seg_clips.append(captions_clip)
+            captions_overlay.add(captions_sprite, start, end, captions_pos)
 
-        video_clip = clip_cleaner(CompositeVideoClip([video_clip, *captions_seg_clips]))
-        return video_clip
+    @staticmethod
+    def build_caption_sprite(text, width):
+        # Captions are rasterized once per process and text, repeated captions reuse the same sprite.
+        return render_caption(text, CAPTION_FONT, 40, width, 'white', 'black', 1, 'center')
 
     @staticmethod
-    def download_materials(param: CompileVideoParam, task_id: str) -> CompileVideoMaterial:
+    def download_materials(param: CompileVideoParam, scratch_name: str, context=None) -> CompileVideoMaterial:
+        # Fetch the bgm and the materials of all shots concurrently.
+        urls = [param.bgm]
+        for shot in param.shots:
+            urls.extend([shot.audio, shot.img, shot.video])
+        with metrics.span("download") as span:
+            files = download_all(urls, scratch_name, context=context)
+            span.add(bytes=sum(os.path.getsize(path) for path in files.values()))
+
         p = CompileVideoMaterial()
-        p.bgm = download(param.bgm, task_id)
+        p.hashes = {filepath: get_content_hash(url, filepath) for url, filepath in files.items()}
+        p.bgm = files[param.bgm]
         # Loop through param.shots, supplementing audio and video.
         for index, shot in enumerate(param.shots):
             sp = ShotMaterial()
             if shot.audio and len(shot.audio) > 0:
-                sp.audio = download(shot.audio, task_id)
+                sp.audio = files[shot.audio]
             if shot.img and len(shot.img) > 0:
-                sp.img = download(shot.img, task_id)
+                sp.img = files[shot.img]
             if shot.video and len(shot.video) > 0:
-                sp.video = download(shot.video, task_id)
+                sp.video = files[shot.video]
             p.shot[index] = sp
         return p
+
+    @staticmethod
+    def normalize_materials(param, material, scratch_name, context) -> CompileVideoMaterial:
+        """
+        The materials conformed to the output, so the render only composes same-size, same-rate shots: every picture
+        is center-cropped to the aspect ratio of the canvas and scaled to the output size, and videos above the output
+        frame rate are resampled to it. Conformed pictures are made once per material and output in the proxy cache and
+        linked into the scratch directory of the job, pictures that already conform are used as they are.
+
+        Captions are still laid out on the canvas at full resolution and drawn scaled to the output, so a preview
+        shows them where the final render puts them.
+        """
+        canvas = tuple(CompileVideoService.get_canvas_size(param, material))
+        # Previews are scaled to PREVIEW_RESOLUTION, renders to the resolution cap of their profile.
+        resolution_cap = PREVIEW_RESOLUTION if param.preview else CompileVideoService.get_profile(param).resolution_cap
+        size = CompileVideoService.get_capped_size(canvas, resolution_cap)
+        fps = CompileVideoService.get_profile(param).fps
+        normalized = material.model_copy(deep=True)
+        normalized.scale = min(size) / min(canvas)
+        # local file path -> (kind, frame rate to resample to), every material is conformed once even if several
+        # shots use it.
+        pictures = {}
+        for shot_material in normalized.shot.values():
+            shot_material.layout_size = canvas
+            if shot_material.video:
+                info = probe(shot_material.video)
+                resample = info.fps is not None and info.fps > fps
+                if tuple(info.size) != size or resample:
+                    pictures[shot_material.video] = ("video", fps if resample else None)
+                    # The conformed video keeps the timing of the original.
+                    shot_material.video_duration = info.video_duration
+            elif shot_material.img and tuple(probe_image(shot_material.img).size) != size:
+                pictures[shot_material.img] = ("img", None)
+        if not pictures:
+            return normalized
+        proxy_cache = get_proxy_cache()
+        proxy_dir = TASK_MATERIAL_DIR.format(task_id=scratch_name)
+
+        def make_proxy(path, kind, proxy_fps):
+            context.check_cancelled()
+            if kind == "video":
+                return proxy_cache.get_video(material.hashes[path], path, size, proxy_dir, proxy_fps)
+            return proxy_cache.get_image(material.hashes[path], path, size, proxy_dir)
+
+        with ThreadPoolExecutor(max_workers=min(PROXY_WORKERS, len(pictures)),
+                                thread_name_prefix="proxy") as executor:
+            futures = {executor.submit(make_proxy, path, kind, proxy_fps): path
+                       for path, (kind, proxy_fps) in pictures.items()}
+            proxy_paths = {}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    proxy_paths[futures[future]] = future.result()
+                    context.report("normalize", done, len(futures))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        for path, proxy_path in proxy_paths.items():
+            # Proxies are keyed by their own content in the segment cache.
+            normalized.hashes[proxy_path] = CompileVideoService.hash_key([material.hashes[path],
+                                                                          os.path.basename(proxy_path)])
+        for shot_material in normalized.shot.values():
+            if shot_material.video:
+                shot_material.video = proxy_paths.get(shot_material.video, shot_material.video)
+            elif shot_material.img:
+                shot_material.img = proxy_paths.get(shot_material.img, shot_material.img)
+        return normalized
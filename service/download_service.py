@@ -1,20 +1,97 @@
+import functools
 import logging
 import os
+import threading
 
-from flask import send_from_directory, abort
+from flask import send_from_directory, abort, make_response
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
 
-from config.common_config import FILE_DIR
+from config.common_config import DOWNLOAD_MAX_CONCURRENCY, DOWNLOAD_STREAM_CHUNK_SIZE
+from utils.storage import find_output
 
 logger = logging.getLogger(__name__)
 
+# Transfers in flight, a slot is held until the response body has been sent.
+_transfers = threading.BoundedSemaphore(DOWNLOAD_MAX_CONCURRENCY)
+
 
 def download(request):
+    """
+    Serve a rendered output with Range, ETag and Last-Modified support.
+
+    Outputs are named after their task and replaced when the task is rendered again, so clients revalidate them
+    on every use, against an ETag of the file: its inode, size and mtime, which change whenever it is replaced or
+    rewritten. The file is streamed in large reads, or handed to the front server with X-Sendfile when
+    DOWNLOAD_X_SENDFILE is set.
+    """
     file_name = request.args.get('file_name')
-    if not os.path.exists(os.path.join(FILE_DIR, file_name)):
+    if not file_name:
+        return abort(400, description="file_name is required")
+    directory = find_output(file_name)
+    path = safe_join(directory, file_name) if directory is not None else None
+    if path is None:
         logger.info("file not found, file_name:%s", file_name)
         return abort(404, description="file not found")
+    if not _transfers.acquire(blocking=False):
+        logger.info("download busy, file_name:%s", file_name)
+        response = make_response("too many downloads", 503)
+        response.headers["Retry-After"] = "1"
+        return response
+    slot = _TransferSlot()
     try:
-        return send_from_directory(FILE_DIR, file_name, as_attachment=True)
+        # The WSGI server has no file wrapper of its own, read in larger blocks than werkzeug's default.
+        request.environ["wsgi.file_wrapper"] = functools.partial(_TransferFileWrapper, slot=slot)
+        response = send_from_directory(directory, file_name, as_attachment=True, conditional=True,
+                                       etag=_file_etag(path))
+        response.cache_control.no_cache = True
+    except (NotFound, FileNotFoundError):
+        # Also when the output is swept between the lookup and the transfer.
+        slot.release()
+        logger.info("file not found, file_name:%s", file_name)
+        return abort(404, description="file not found")
+    except HTTPException:
+        # e.g. 416 for a range outside the file.
+        slot.release()
+        raise
     except Exception as e:
+        slot.release()
         logger.error("download error, file_name:%s, error:%s", file_name, e, exc_info=True)
         return abort(500, description="download error")
+    if request.method == "HEAD" or response.status_code == 304 or not slot.streaming:
+        # No body is streamed, e.g. on a cache revalidation or with X-Sendfile.
+        response.close()
+        slot.release()
+    return response
+
+
+def _file_etag(path) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+
+class _TransferSlot:
+    def __init__(self):
+        self.streaming = False
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            _transfers.release()
+
+
+class _TransferFileWrapper(FileWrapper):
+    """
+    Streams the file in DOWNLOAD_STREAM_CHUNK_SIZE reads and frees the transfer slot once the server closes it.
+    """
+
+    def __init__(self, file, buffer_size=DOWNLOAD_STREAM_CHUNK_SIZE, slot=None):
+        super().__init__(file, max(buffer_size, DOWNLOAD_STREAM_CHUNK_SIZE))
+        self.slot = slot
+        slot.streaming = True
+
+    def close(self):
+        super().close()
+        self.slot.release()
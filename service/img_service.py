@@ -1,27 +1,113 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, List
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 
-from config.common_config import FILE_DIR
-from utils.file_downloader import download
-from utils.img_utils import img_resize
+from config.common_config import IMG_FORMATS, IMG_RESIZE_WORKERS
+from utils import metrics
+from utils.file_downloader import download, download_all
+from utils.img_utils import open_img, fit_img, save_img
+from utils.job_context import JobContext
+from utils.storage import output_path, new_scratch_name, remove_task_materials
 
 logger = logging.getLogger(__name__)
 
 
-class ImgResizeParam(BaseModel):
+class ImgOutputOptions(BaseModel):
+    # Output format, JPEG, PNG or WEBP. Keeps the format of the source image by default.
+    format: Optional[str] = None
+    quality: Optional[int] = None
+
+    @field_validator("format")
+    @classmethod
+    def check_format(cls, format):
+        if format is not None and format.upper() not in IMG_FORMATS:
+            raise ValueError(f"unknown image format: {format}")
+        return format.upper() if format is not None else None
+
+
+class ImgResizeParam(ImgOutputOptions):
     img: str
     width: int
     height: int
 
 
+class ImgSize(BaseModel):
+    width: int
+    height: int
+
+
+class ImgResizeBatchItem(BaseModel):
+    img: str
+    sizes: List[ImgSize]
+
+
+class ImgResizeBatchParam(ImgOutputOptions):
+    images: List[ImgResizeBatchItem]
+
+
 class ImgService:
     @staticmethod
-    def resize_img(task_id: str, param: ImgResizeParam):
-        material = download(param.img, task_id)
-        img, format = img_resize(material, param.width, param.height)
-        img_name = task_id + "." + format.lower()
-        path = FILE_DIR + img_name
-        img.save(path)
+    def resize_img(task_id: str, param: ImgResizeParam, context: Optional[JobContext] = None):
+        scratch_name = new_scratch_name(task_id)
+        try:
+            material = download(param.img, scratch_name, context=context)
+            if context is not None:
+                context.check_cancelled()
+            with metrics.span("img_resize") as span:
+                img = open_img(material, [(param.width, param.height)])
+                format = param.format or img.format
+                img_name = task_id + "." + format.lower()
+                save_img(fit_img(img, param.width, param.height), output_path(img_name), format, param.quality)
+                span.add(frames=1)
+        finally:
+            remove_task_materials(scratch_name)
         logger.info("img_resize success, task_id: %s, img: %s", task_id, img_name)
         return {"img": img_name}
+
+    @staticmethod
+    def resize_img_batch(task_id: str, param: ImgResizeBatchParam, context: Optional[JobContext] = None):
+        """
+        Resize every image of the batch to each of its sizes. Every image is decoded once for all of its sizes, and
+        images are processed on a thread pool, PIL releases the GIL while decoding, resizing and encoding.
+        """
+        scratch_name = new_scratch_name(task_id)
+        try:
+            files = download_all([item.img for item in param.images], scratch_name, context=context)
+            results = [None] * len(param.images)
+            with ThreadPoolExecutor(max_workers=min(IMG_RESIZE_WORKERS, len(param.images)),
+                                    thread_name_prefix="img-resize") as executor:
+                futures = {executor.submit(ImgService.resize_batch_item, task_id, index, item, files[item.img], param,
+                                           context): index for index, item in enumerate(param.images)}
+                try:
+                    for done, future in enumerate(as_completed(futures), 1):
+                        results[futures[future]] = future.result()
+                        if context is not None:
+                            context.report("resize", done, len(futures))
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            remove_task_materials(scratch_name)
+        logger.info("img_resize_batch success, task_id: %s, images: %s", task_id, len(results))
+        return {"images": results}
+
+    @staticmethod
+    def resize_batch_item(task_id, index, item: ImgResizeBatchItem, material, options: ImgOutputOptions,
+                          context: Optional[JobContext]):
+        if context is not None:
+            context.check_cancelled()
+        outputs = []
+        with metrics.span("img_resize") as span, \
+                open_img(material, [(size.width, size.height) for size in item.sizes]) as img:
+            # Decode once for all sizes.
+            img.load()
+            format = options.format or img.format
+            for size in item.sizes:
+                img_name = f"{task_id}_{index}_{size.width}x{size.height}.{format.lower()}"
+                save_img(fit_img(img, size.width, size.height), output_path(img_name), format, options.quality)
+                outputs.append({"width": size.width, "height": size.height, "img": img_name})
+            span.add(frames=len(outputs))
+        return {"img": item.img, "outputs": outputs}
@@ -0,0 +1,392 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from config.common_config import JOB_QUEUE_SIZE, JOB_QUEUE_SIZE_PER_CONNECTION, JOB_BROKER_POLL_INTERVAL, \
+    JOB_BROKER_LEASE, JOB_BROKER_RETENTION
+from service.job_scheduler import Job
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    origin TEXT NOT NULL,
+    task_id TEXT,
+    kind TEXT NOT NULL,
+    fn TEXT NOT NULL,
+    args BLOB NOT NULL,
+    status TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    heartbeat REAL,
+    result BLOB,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (kind, status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_origin ON jobs (origin, status);
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_origin ON events (origin, event_id);
+"""
+
+
+def job_name(fn) -> str:
+    """
+    The importable name of a job function, e.g. ``service.img_service:ImgService.resize_img``.
+    """
+    return f"{fn.__module__}:{fn.__qualname__}"
+
+
+def resolve_job(name):
+    module_name, qualname = name.split(":", 1)
+    target = importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        target = getattr(target, attr)
+    return target
+
+
+def create_broker(url):
+    if url.startswith("sqlite:///"):
+        return SqliteBroker(url[len("sqlite:///"):])
+    raise ValueError(f"unsupported job broker: {url}")
+
+
+class SqliteBroker:
+    """
+    Job broker on a SQLite database, the stand-in for a networked broker on one host or a shared volume.
+
+    Jobs are claimed in a write transaction, so every job runs on exactly one worker. A claimed job holds a lease
+    renewed by the heartbeats of its worker, the job of a worker that died is queued again once the lease expired.
+    Progress events and results are kept until the submitting server has taken them.
+    """
+
+    def __init__(self, path, lease=JOB_BROKER_LEASE, retention=JOB_BROKER_RETENTION):
+        self.path = path
+        self.lease = lease
+        self.retention = retention
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connect().executescript(_SCHEMA)
+
+    def __reduce__(self):
+        # Connections are per thread and process, a copy opens its own.
+        return SqliteBroker, (self.path, self.lease, self.retention)
+
+    def enqueue(self, job_id, origin, task_id, kind, fn, args):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO jobs (job_id, origin, task_id, kind, fn, args, status, created_at, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, origin, task_id, kind, fn, pickle.dumps(args), JOB_PENDING, now, now))
+
+    def claim(self, worker, kind) -> Optional[sqlite3.Row]:
+        """
+        Take the oldest pending job of ``kind``, None if there is none.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            expired = conn.execute("UPDATE jobs SET status = ?, worker = NULL, updated_at = ? "
+                                   "WHERE kind = ? AND status = ? AND heartbeat < ?",
+                                   (JOB_PENDING, now, kind, JOB_RUNNING, now - self.lease)).rowcount
+            if expired:
+                logger.warning("job broker requeue expired jobs, kind: %s, count: %s", kind, expired)
+            job = conn.execute("SELECT * FROM jobs WHERE kind = ? AND status = ? ORDER BY created_at LIMIT 1",
+                               (kind, JOB_PENDING)).fetchone()
+            if job is None:
+                return None
+            conn.execute("UPDATE jobs SET status = ?, worker = ?, heartbeat = ?, updated_at = ? WHERE job_id = ?",
+                         (JOB_RUNNING, worker, now, now, job["job_id"]))
+            return job
+
+    def heartbeat(self, worker, job_ids):
+        if not job_ids:
+            return
+        with self._transaction() as conn:
+            conn.executemany("UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND worker = ?",
+                             [(time.time(), job_id, worker) for job_id in job_ids])
+
+    def finish(self, job_id, worker, status, result):
+        """
+        Record the result of a job, the return value for JOB_DONE and the exception for JOB_FAILED.
+        """
+        error = None if status == JOB_DONE else str(result)
+        try:
+            blob = pickle.dumps(result)
+        except Exception:
+            # Exceptions that do not pickle are passed on with their message.
+            blob = pickle.dumps(RuntimeError(error))
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                         "WHERE job_id = ? AND worker = ? AND status = ?",
+                         (status, blob, error, time.time(), job_id, worker, JOB_RUNNING))
+
+    def cancel_pending(self, job_id) -> bool:
+        """
+        Cancel a job no worker has claimed yet, return whether it was still pending.
+        """
+        with self._transaction() as conn:
+            return conn.execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ? AND status = ?",
+                                (JOB_CANCELLED, time.time(), job_id, JOB_PENDING)).rowcount > 0
+
+    def request_cancel(self, job_id):
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+
+    def is_cancel_requested(self, job_id) -> bool:
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def push_event(self, job_id, event):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO events (job_id, origin, data, created_at) "
+                         "SELECT job_id, origin, ?, ? FROM jobs WHERE job_id = ?",
+                         (json.dumps(event), time.time(), job_id))
+
+    def take_events(self, origin) -> list:
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT event_id, job_id, data FROM events WHERE origin = ? ORDER BY event_id",
+                                (origin,)).fetchall()
+            if rows:
+                conn.execute("DELETE FROM events WHERE origin = ? AND event_id <= ?", (origin, rows[-1]["event_id"]))
+        return [(row["job_id"], json.loads(row["data"])) for row in rows]
+
+    def take_finished(self, origin) -> list:
+        placeholders = ",".join("?" * len(FINISHED_STATUSES))
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(f"SELECT job_id, status, result, error FROM jobs "
+                                f"WHERE origin = ? AND status IN ({placeholders})",
+                                (origin, *FINISHED_STATUSES)).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(row["job_id"],) for row in rows])
+            # Jobs and events of servers that are gone.
+            conn.execute(f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+                         (*FINISHED_STATUSES, now - self.retention))
+            conn.execute("DELETE FROM events WHERE created_at < ?", (now - self.retention,))
+        return rows
+
+    def counts(self) -> dict:
+        """
+        The number of queued and running jobs by (kind, status).
+        """
+        rows = self._connect().execute("SELECT kind, status, COUNT(*) AS count FROM jobs WHERE status IN (?, ?) "
+                                       "GROUP BY kind, status", (JOB_PENDING, JOB_RUNNING)).fetchall()
+        return {(row["kind"], row["status"]): row["count"] for row in rows}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit, transactions are opened explicitly.
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class BrokerEvents:
+    """
+    Progress event queue of a JobContext on a broker.
+    """
+
+    def __init__(self, broker, job_id):
+        self.broker = broker
+        self.job_id = job_id
+
+    def put(self, event):
+        self.broker.push_event(self.job_id, event)
+
+
+class BrokerCancelFlag:
+    """
+    Cancel flag of a JobContext on a broker.
+    """
+
+    def __init__(self, broker, job_id):
+        self.broker = broker
+        self.job_id = job_id
+
+    def set(self):
+        self.broker.request_cancel(self.job_id)
+
+    def is_set(self):
+        return self.broker.is_cancel_requested(self.job_id)
+
+
+class BrokerJobQueue:
+    """
+    Job queue with the interface of JobScheduler that hands the jobs to job workers through a broker.
+
+    Jobs are queued with the importable name of their function and their pickled arguments, so every node must run
+    the same code. A notifier thread polls the broker for the progress events and results of the jobs submitted by
+    this server and routes them to the callbacks and futures of the jobs on the event loop, and so back to the
+    connection that submitted them.
+    """
+
+    def __init__(self, broker, max_pending=JOB_QUEUE_SIZE, max_pending_per_connection=JOB_QUEUE_SIZE_PER_CONNECTION,
+                 poll_interval=JOB_BROKER_POLL_INTERVAL):
+        self.broker = broker
+        self.origin = uuid.uuid4().hex
+        self.poll_interval = poll_interval
+        self._max_pending_per_connection = max_pending_per_connection
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._connection_capacity = {}
+        # broker job id -> job submitted by this server and not finished yet.
+        self._jobs = {}
+        self._notifier = None
+        self._stop = threading.Event()
+        metrics.register_gauge("jobs_pending", "Jobs waiting for a worker.",
+                               lambda: self._count_gauge("pending"))
+        metrics.register_gauge("jobs_running", "Jobs running on a worker.",
+                               lambda: self._count_gauge("running"))
+
+    async def submit(self, connection_id, kind, fn, *args, task_id=None, on_progress=None) -> asyncio.Future:
+        """
+        Queue ``fn(*args, context=...)`` on the broker and return a future of its result. Waits for a free slot
+        first.
+        """
+        loop = asyncio.get_running_loop()
+        if self._notifier is None:
+            self._notifier = threading.Thread(target=self._notify, args=(loop,), name="job-notifier", daemon=True)
+            self._notifier.start()
+        connection_capacity = self._connection_capacity.setdefault(
+            connection_id, asyncio.Semaphore(self._max_pending_per_connection))
+        await connection_capacity.acquire()
+        try:
+            await self._capacity.acquire()
+        except BaseException:
+            connection_capacity.release()
+            raise
+
+        job = Job(connection_id, kind, fn, args, task_id, on_progress)
+        job.future.add_done_callback(lambda _: self._release(connection_capacity))
+        broker_job_id = f"{self.origin}-{job.job_id}"
+        # Registered before it is queued, the notifier may poll its events and result before enqueue returns.
+        self._jobs[broker_job_id] = job
+        try:
+            await loop.run_in_executor(None, self.broker.enqueue, broker_job_id, self.origin, task_id, kind,
+                                       job_name(fn), args)
+        except BaseException:
+            self._jobs.pop(broker_job_id, None)
+            job.future.cancel()
+            raise
+        return job.future
+
+    def cancel(self, connection_id, task_id) -> bool:
+        """
+        Cancel the queued or running jobs of a task submitted over the connection, return whether there were any.
+        """
+        found = False
+        for broker_job_id, job in list(self._jobs.items()):
+            if job.connection_id == connection_id and job.task_id == task_id:
+                self._cancel(broker_job_id, job)
+                found = True
+        return found
+
+    def release_connection(self, connection_id):
+        """
+        Cancel the queued and running jobs of a closed connection.
+        """
+        for broker_job_id, job in list(self._jobs.items()):
+            if job.connection_id == connection_id:
+                self._cancel(broker_job_id, job)
+        self._connection_capacity.pop(connection_id, None)
+
+    def queue_depth(self):
+        return sum(count for (_, status), count in self.broker.counts().items() if status == JOB_PENDING)
+
+    def shutdown(self):
+        self._stop.set()
+
+    def _cancel(self, broker_job_id, job):
+        try:
+            if self.broker.cancel_pending(broker_job_id):
+                self._jobs.pop(broker_job_id, None)
+                job.future.cancel()
+            else:
+                # The worker raises JobCancelled inside the job, its result reports the cancellation.
+                self.broker.request_cancel(broker_job_id)
+        except sqlite3.Error as e:
+            logger.error("job cancel failed, task_id: %s, error: %s", job.task_id, e, exc_info=True)
+
+    def _notify(self, loop):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                events = self.broker.take_events(self.origin)
+                finished = self.broker.take_finished(self.origin)
+            except sqlite3.Error as e:
+                logger.error("job broker poll failed, error: %s", e, exc_info=True)
+                continue
+            if events or finished:
+                loop.call_soon_threadsafe(self._on_poll, events, finished)
+
+    def _on_poll(self, events, finished):
+        for broker_job_id, event in events:
+            job = self._jobs.get(broker_job_id)
+            if job is None or job.on_progress is None or job.future.done():
+                continue
+            try:
+                job.on_progress(event)
+            except Exception as e:
+                logger.error("job progress callback failed, task_id: %s, error: %s", job.task_id, e, exc_info=True)
+        for row in finished:
+            job = self._jobs.pop(row["job_id"], None)
+            if job is None or job.future.done():
+                continue
+            if row["status"] == JOB_CANCELLED:
+                job.future.cancel()
+                continue
+            try:
+                result = pickle.loads(row["result"])
+            except Exception:
+                # e.g. an exception class this server cannot import.
+                job.future.set_exception(RuntimeError(row["error"] or "job result unreadable"))
+                continue
+            if row["status"] == JOB_DONE:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(result)
+
+    def _release(self, connection_capacity):
+        connection_capacity.release()
+        self._capacity.release()
+
+    def _count_gauge(self, status):
+        return {(("kind", kind),): count for (kind, job_status), count in self.broker.counts().items()
+                if job_status == status}
@@ -0,0 +1,15 @@
+from config.common_config import JOB_QUEUE_BACKEND, JOB_BROKER_URL
+from service.job_broker import BrokerJobQueue, create_broker
+from service.job_scheduler import JobScheduler
+
+
+def create_job_queue():
+    """
+    The job queue of the websocket server: jobs run in the worker pools of this process ("local"), or on the job
+    workers of a broker ("broker"). Both have the interface of JobScheduler.
+    """
+    if JOB_QUEUE_BACKEND == "local":
+        return JobScheduler()
+    if JOB_QUEUE_BACKEND == "broker":
+        return BrokerJobQueue(create_broker(JOB_BROKER_URL))
+    raise ValueError(f"unknown job queue backend: {JOB_QUEUE_BACKEND}")
@@ -0,0 +1,269 @@
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import log_config
+from config.common_config import RENDER_WORKERS, RESIZE_WORKERS, JOB_QUEUE_SIZE, JOB_QUEUE_SIZE_PER_CONNECTION
+from utils import metrics
+from utils.job_context import JobContext
+
+logger = logging.getLogger(__name__)
+
+# CPU-bound jobs (video renders), executed in worker processes.
+JOB_KIND_RENDER = "render"
+# I/O-bound jobs (image download and resize), executed in worker threads.
+JOB_KIND_IO = "io"
+
+
+def share_of_cores(slots, running) -> int:
+    """
+    The cores a job starting in one of ``slots`` worker slots may use, with ``running`` jobs including it: its own
+    share and those of the idle slots, e.g. for its segment pool.
+    """
+    return max(1, (slots - running + 1) * (os.cpu_count() or 1) // max(slots, 1))
+
+
+class Job:
+    _ids = itertools.count()
+
+    def __init__(self, connection_id, kind, fn, args, task_id=None, on_progress=None):
+        self.job_id = next(Job._ids)
+        self.connection_id = connection_id
+        self.kind = kind
+        self.fn = fn
+        self.args = args
+        self.task_id = task_id
+        self.on_progress = on_progress
+        self.context = None
+        self.future = asyncio.get_running_loop().create_future()
+        self.start_task = None
+
+
+class JobScheduler:
+    """
+    Runs jobs off the event loop on bounded worker pools.
+
+    Accepted jobs are queued per connection and dispatched round-robin across connections, so a client that submits
+    many jobs cannot starve the others. ``submit`` waits while the queue is full, which pushes back on the reader of
+    the websocket instead of buffering unbounded work.
+
+    Every job gets a JobContext, its progress events are relayed from the workers to the ``on_progress`` callback of
+    the job on the event loop, and ``cancel`` raises JobCancelled inside a running job.
+    """
+
+    def __init__(self, render_workers=RENDER_WORKERS, io_workers=RESIZE_WORKERS, max_pending=JOB_QUEUE_SIZE,
+                 max_pending_per_connection=JOB_QUEUE_SIZE_PER_CONNECTION):
+        self._workers = {JOB_KIND_RENDER: render_workers, JOB_KIND_IO: io_workers}
+        self._executors = {
+            # Started with the first render, once the server has configured its logging.
+            JOB_KIND_RENDER: None,
+            JOB_KIND_IO: ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io-job"),
+        }
+        self._running = {JOB_KIND_RENDER: 0, JOB_KIND_IO: 0}
+        # kind -> connection_id -> pending jobs, the order of the connections is the round-robin order.
+        self._pending = {JOB_KIND_RENDER: OrderedDict(), JOB_KIND_IO: OrderedDict()}
+        self._max_pending_per_connection = max_pending_per_connection
+        self._capacity = asyncio.Semaphore(max_pending)
+        self._connection_capacity = {}
+        self._running_jobs = {}
+        metrics.register_gauge("jobs_pending", "Jobs waiting for a worker.", lambda: {
+            (("kind", kind),): sum(len(jobs) for jobs in list(pending.values())) for kind, pending in self._pending.items()})
+        metrics.register_gauge("jobs_running", "Jobs running on a worker.", lambda: {
+            (("kind", kind),): running for kind, running in self._running.items()})
+        # Started with the first job: a manager process holding the progress queue and the cancel flags.
+        self._manager = None
+        self._manager_lock = threading.Lock()
+        self._events = None
+
+    async def submit(self, connection_id, kind, fn, *args, task_id=None, on_progress=None) -> asyncio.Future:
+        """
+        Queue ``fn(*args, context=...)`` on the pool of ``kind`` and return a future of its result. Waits for a free
+        slot first.
+        """
+        if self._manager is None:
+            await asyncio.get_running_loop().run_in_executor(None, self._start_manager, asyncio.get_running_loop())
+        connection_capacity = self._connection_capacity.setdefault(
+            connection_id, asyncio.Semaphore(self._max_pending_per_connection))
+        await connection_capacity.acquire()
+        try:
+            await self._capacity.acquire()
+        except BaseException:
+            connection_capacity.release()
+            raise
+
+        job = Job(connection_id, kind, fn, args, task_id, on_progress)
+        job.future.add_done_callback(lambda _: self._release(connection_capacity))
+        self._pending[kind].setdefault(connection_id, deque()).append(job)
+        self._dispatch(kind)
+        return job.future
+
+    def cancel(self, connection_id, task_id) -> bool:
+        """
+        Cancel the queued or running jobs of a task submitted over the connection, return whether there were any.
+        """
+        found = False
+        for pending in self._pending.values():
+            jobs = pending.get(connection_id)
+            if not jobs:
+                continue
+            for job in [job for job in jobs if job.task_id == task_id]:
+                jobs.remove(job)
+                job.future.cancel()
+                found = True
+            if not jobs:
+                del pending[connection_id]
+        for job in list(self._running_jobs.values()):
+            if job.connection_id == connection_id and job.task_id == task_id:
+                self._cancel_running(job)
+                found = True
+        return found
+
+    def release_connection(self, connection_id):
+        """
+        Drop the queued jobs of a closed connection and cancel its running jobs.
+        """
+        for pending in self._pending.values():
+            for job in pending.pop(connection_id, ()):
+                job.future.cancel()
+        for job in list(self._running_jobs.values()):
+            if job.connection_id == connection_id:
+                self._cancel_running(job)
+        self._connection_capacity.pop(connection_id, None)
+
+    def queue_depth(self):
+        return sum(len(jobs) for pending in self._pending.values() for jobs in pending.values())
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            if executor is None:
+                continue
+            executor.shutdown(wait=False, cancel_futures=True)
+        if self._manager is not None:
+            self._manager.shutdown()
+
+    def _start_manager(self, loop):
+        # Runs on executor threads, concurrent submits start a single manager.
+        with self._manager_lock:
+            if self._manager is not None:
+                return
+            manager = multiprocessing.get_context("spawn").Manager()
+            self._events = manager.Queue()
+            threading.Thread(target=self._relay_events, args=(self._events, loop), name="job-events",
+                             daemon=True).start()
+            self._manager = manager
+
+    def _relay_events(self, events, loop):
+        while True:
+            try:
+                event = events.get()
+            except (EOFError, OSError):
+                # The manager has been shut down.
+                return
+            loop.call_soon_threadsafe(self._on_event, event)
+
+    def _on_event(self, event):
+        job = self._running_jobs.get(event.get("job_id"))
+        if job is None or job.on_progress is None or job.future.done():
+            return
+        try:
+            job.on_progress(event)
+        except Exception as e:
+            logger.error("job progress callback failed, task_id: %s, error: %s", job.task_id, e, exc_info=True)
+
+    def _release(self, connection_capacity):
+        connection_capacity.release()
+        self._capacity.release()
+
+    def _dispatch(self, kind):
+        pending = self._pending[kind]
+        while pending and self._running[kind] < self._workers[kind]:
+            connection_id, jobs = next(iter(pending.items()))
+            job = jobs.popleft()
+            # Move the connection to the back of the round-robin order.
+            del pending[connection_id]
+            if jobs:
+                pending[connection_id] = jobs
+            if not job.future.done():
+                self._start(job)
+
+    def _start(self, job):
+        # The worker slot is taken right away, the job runs once its cancel flag is created.
+        self._running[job.kind] += 1
+        self._running_jobs[job.job_id] = job
+        job.start_task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            # Creating the flag is a round trip to the manager process, made off the event loop.
+            cancel_event = await loop.run_in_executor(None, self._manager.Event)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            self._finish(job)
+            return
+        if job.future.done():
+            # Cancelled while its flag was created.
+            self._finish(job)
+            return
+        job.context = JobContext(job.task_id, job.job_id, self._events, cancel_event,
+                                 cores=share_of_cores(self._workers[job.kind], self._running[job.kind]))
+        fn = functools.partial(job.fn, *job.args, context=job.context)
+        if self._executors[job.kind] is None:
+            self._executors[job.kind] = self._new_render_executor()
+        executor = self._executors[job.kind]
+        try:
+            run = loop.run_in_executor(executor, fn)
+        except BrokenProcessPool:
+            # A worker of the pool died since the last job finished.
+            executor = self._replace_broken_executor(job.kind, executor)
+            run = loop.run_in_executor(executor, fn)
+
+        def on_done(f):
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                # A worker died, e.g. killed out of memory. The jobs running in the pool fail, later jobs run in a
+                # new pool.
+                self._replace_broken_executor(job.kind, executor)
+            if not job.future.done():
+                if f.cancelled():
+                    job.future.cancel()
+                elif f.exception() is not None:
+                    job.future.set_exception(f.exception())
+                else:
+                    job.future.set_result(f.result())
+            self._finish(job)
+
+        run.add_done_callback(on_done)
+
+    def _new_render_executor(self):
+        # Worker processes are spawned rather than forked, the server process runs several threads. Spawned
+        # processes log through the server process.
+        return ProcessPoolExecutor(max_workers=self._workers[JOB_KIND_RENDER],
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=log_config.init_worker, initargs=(log_config.worker_queue(),))
+
+    def _replace_broken_executor(self, kind, broken):
+        if self._executors[kind] is broken:
+            logger.error("job worker pool broken, starting a new one, kind: %s", kind)
+            self._executors[kind] = self._new_render_executor()
+            broken.shutdown(wait=False)
+        return self._executors[kind]
+
+    def _finish(self, job):
+        self._running[job.kind] -= 1
+        self._running_jobs.pop(job.job_id, None)
+        self._dispatch(job.kind)
+
+    def _cancel_running(self, job):
+        if job.context is None:
+            # Not started on its worker yet.
+            job.future.cancel()
+        else:
+            job.context.cancel()
@@ -0,0 +1,167 @@
+"""
+Job worker pulling the jobs of websocket servers with JOB_QUEUE_BACKEND = "broker" from JOB_BROKER_URL.
+
+Workers keep no state of their own: materials, renders and outputs live in FILE_DIR and the data directory, shared
+by all nodes. Start as many workers on as many nodes as needed.
+
+    python -m service.job_worker --render-workers 4 --io-workers 8
+"""
+import argparse
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import log_config
+from config.common_config import RENDER_WORKERS, RESIZE_WORKERS, JOB_BROKER_URL, JOB_BROKER_POLL_INTERVAL, \
+    JOB_WORKER_LOG_FILE
+from service.job_broker import create_broker, resolve_job, BrokerEvents, BrokerCancelFlag, JOB_DONE, JOB_FAILED
+from service.job_scheduler import JOB_KIND_RENDER, JOB_KIND_IO, share_of_cores
+from utils import metrics
+from utils.job_context import JobContext
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorker:
+    """
+    Runs jobs claimed from a broker, renders in worker processes and I/O jobs in threads, like JobScheduler.
+
+    Every slot claims its next job once its current job is done, so a busy worker leaves the queued jobs to the
+    others. The heartbeat of the running jobs keeps their lease on the broker.
+    """
+
+    def __init__(self, broker, render_workers=RENDER_WORKERS, io_workers=RESIZE_WORKERS,
+                 poll_interval=JOB_BROKER_POLL_INTERVAL):
+        self.broker = broker
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.poll_interval = poll_interval
+        self._slots = {JOB_KIND_RENDER: render_workers, JOB_KIND_IO: io_workers}
+        self._executor = self._new_executor()
+        self._executor_lock = threading.Lock()
+        self._running = set()
+        self._running_kinds = {kind: 0 for kind in self._slots}
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self):
+        """
+        Work until ``stop``, then wait for the running jobs.
+        """
+        threads = [threading.Thread(target=self._work, args=(kind,), name=f"{kind}-slot-{i}")
+                   for kind, slots in self._slots.items() for i in range(slots)]
+        for thread in threads:
+            thread.start()
+        logger.info("job worker started, worker: %s, slots: %s", self.worker_id, self._slots)
+        while not self._stop.wait(self.broker.lease / 3):
+            with self._running_lock:
+                running = list(self._running)
+            try:
+                self.broker.heartbeat(self.worker_id, running)
+            except sqlite3.Error as e:
+                logger.error("job heartbeat failed, error: %s", e, exc_info=True)
+            # Hosts without a server have the metrics files of their exited processes merged here.
+            metrics.prune()
+        for thread in threads:
+            thread.join()
+        self._executor.shutdown()
+
+    def stop(self):
+        self._stop.set()
+
+    def _work(self, kind):
+        while not self._stop.is_set():
+            try:
+                job = self.broker.claim(self.worker_id, kind)
+            except sqlite3.Error as e:
+                logger.error("job claim failed, error: %s", e, exc_info=True)
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            with self._running_lock:
+                self._running.add(job["job_id"])
+                self._running_kinds[kind] += 1
+                cores = share_of_cores(self._slots[kind], self._running_kinds[kind])
+            try:
+                self._run(job, cores)
+            finally:
+                with self._running_lock:
+                    self._running.discard(job["job_id"])
+                    self._running_kinds[kind] -= 1
+
+    def _run(self, job, cores):
+        job_id = job["job_id"]
+        logger.info("job begin, job_id: %s, task_id: %s, fn: %s", job_id, job["task_id"], job["fn"])
+        context = JobContext(job["task_id"], job_id, BrokerEvents(self.broker, job_id),
+                             BrokerCancelFlag(self.broker, job_id), cores=cores)
+        try:
+            fn = functools.partial(resolve_job(job["fn"]), *pickle.loads(job["args"]), context=context)
+            if job["kind"] == JOB_KIND_RENDER:
+                result = self._run_render(fn)
+            else:
+                result = fn()
+            status = JOB_DONE
+        except Exception as e:
+            logger.info("job failed, job_id: %s, error: %s", job_id, e)
+            result = e
+            status = JOB_FAILED
+        self.broker.finish(job_id, self.worker_id, status, result)
+        logger.info("job end, job_id: %s, status: %s", job_id, status)
+
+
+    def _run_render(self, fn):
+        executor = self._executor
+        try:
+            future = executor.submit(fn)
+        except BrokenProcessPool:
+            # A worker of the pool died during another job.
+            executor = self._replace_broken_executor(executor)
+            future = executor.submit(fn)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed out of memory. The jobs running in the pool fail, the next jobs claimed run
+            # in a new pool.
+            self._replace_broken_executor(executor)
+            raise
+
+    def _new_executor(self):
+        # Worker processes are spawned rather than forked, the worker runs several threads. Spawned processes log
+        # through the job worker, like the pools of the server.
+        return ProcessPoolExecutor(max_workers=max(self._slots[JOB_KIND_RENDER], 1),
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=log_config.init_worker, initargs=(log_config.worker_queue(),))
+
+    def _replace_broken_executor(self, broken):
+        with self._executor_lock:
+            if self._executor is broken:
+                logger.error("job worker pool broken, starting a new one, worker: %s", self.worker_id)
+                self._executor = self._new_executor()
+                broken.shutdown(wait=False)
+            return self._executor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the jobs queued on the job broker.")
+    parser.add_argument("--broker", default=JOB_BROKER_URL)
+    parser.add_argument("--render-workers", type=int, default=RENDER_WORKERS)
+    parser.add_argument("--io-workers", type=int, default=RESIZE_WORKERS)
+    args = parser.parse_args()
+    # The server rotates LOG_FILE, a worker on the same node has a file of its own.
+    log_config.init(JOB_WORKER_LOG_FILE.format(pid=os.getpid()))
+    worker = JobWorker(create_broker(args.broker), args.render_workers, args.io_workers)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
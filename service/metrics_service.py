@@ -0,0 +1,35 @@
+from flask import Response
+
+from utils import metrics
+from utils.ffmpeg_utils import count_ffmpeg_processes
+
+
+def _ffmpeg_processes():
+    count = count_ffmpeg_processes()
+    return {} if count is None else {(): count}
+
+
+def _cache_hit_ratios():
+    counters = metrics.get_registry().collect()["counters"]
+    ratios = {}
+    material = counters.get(metrics.PREFIX + "material_cache_lookups_total", {})
+    lookups = sum(material.values())
+    if lookups:
+        hits = material.get("result=hit", 0) + material.get("result=revalidated", 0)
+        ratios[(("cache", "material"),)] = hits / lookups
+    render = counters.get(metrics.PREFIX + "render_cache_lookups_total", {})
+    for kind in ("output", "segment"):
+        hits = render.get(f"kind={kind},result=hit", 0)
+        lookups = hits + render.get(f"kind={kind},result=miss", 0)
+        if lookups:
+            ratios[(("cache", kind),)] = hits / lookups
+    return ratios
+
+
+metrics.register_gauge("ffmpeg_processes", "Running ffmpeg processes.", _ffmpeg_processes)
+metrics.register_gauge("cache_hit_ratio", "Hit ratio of the material and render caches since startup.",
+                       _cache_hit_ratios)
+
+
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -1,20 +1,93 @@
+import math
+from bisect import bisect_right
+
 import numpy as np
-from moviepy import concatenate_audioclips
-from moviepy.audio.AudioClip import AudioArrayClip
+from moviepy.audio.AudioClip import AudioClip
+
+
+class AudioTimeline:
+    """
+    Plan of an audio track: where each source starts on the timeline, which part of it plays and at what volume.
+
+    Nothing is mixed while planning. The track is mixed by ``clip`` chunk by chunk as the writer asks for it, only
+    the sources overlapping a chunk are read and silence is never materialized, so memory stays flat however long
+    the timeline is.
+    """
+
+    def __init__(self, duration, fps=44100, nchannels=2):
+        self.duration = duration
+        self.fps = fps
+        self.nchannels = nchannels
+        self.placements = []
+
+    def add(self, source, start=0, volume=1.0, loop=False):
+        """
+        Play the audio clip ``source`` from ``start``, cut at the end of the timeline. With ``loop`` it is repeated
+        until the end of the timeline.
+        """
+        if source.duration <= 0:
+            return
+        if not loop:
+            self._place(source, start, min(start + source.duration, self.duration), 0, volume)
+            return
+        for i in range(math.ceil((self.duration - start) / source.duration)):
+            loop_start = start + i * source.duration
+            self._place(source, loop_start, min(loop_start + source.duration, self.duration), 0, volume)
+
+    def extend(self, timeline, start):
+        """
+        Add every source of another timeline, shifted by ``start``.
+        """
+        for placement in timeline.placements:
+            self._place(placement.source, placement.start + start,
+                        min(placement.end + start, start + timeline.duration, self.duration),
+                        placement.source_start, placement.volume)
+
+    def clip(self):
+        return TimelineAudioClip(self)
+
+    def _place(self, source, start, end, source_start, volume):
+        if end > start:
+            self.placements.append(_Placement(source, start, end, source_start, volume))
+
 
+class TimelineAudioClip(AudioClip):
+    """
+    AudioClip mixing an AudioTimeline on demand.
+    """
 
-# Extend the audio file by adding silence at the beginning/end
-def extend_audio(audio_clip, duration=1, reverse=False):
-    silent_audio = audio_clip.subclipped(0, duration).with_volume_scaled(0)
+    def __init__(self, timeline: AudioTimeline):
+        self.nchannels = timeline.nchannels
+        self.timeline = timeline
+        self._placements = sorted(timeline.placements, key=lambda p: p.start)
+        self._starts = [placement.start for placement in self._placements]
+        super().__init__(frame_function=self.mix, duration=timeline.duration, fps=timeline.fps)
 
-    if reverse:
-        return concatenate_audioclips([silent_audio, audio_clip])
-    else:
-        return concatenate_audioclips([audio_clip, silent_audio])
+    def mix(self, t):
+        scalar = np.ndim(t) == 0
+        tt = np.atleast_1d(np.asarray(t, dtype=float))
+        out = np.zeros((len(tt), self.nchannels))
+        t_min, t_max = tt.min(), tt.max()
+        for placement in self._placements[:bisect_right(self._starts, t_max)]:
+            if placement.end <= t_min:
+                continue
+            mask = (tt >= placement.start) & (tt < placement.end)
+            if not mask.any():
+                continue
+            frames = placement.source.get_frame(tt[mask] - placement.start + placement.source_start)
+            frames = np.asarray(frames, dtype=float).reshape(int(mask.sum()), -1)
+            if placement.volume != 1:
+                # Not in place, frames may be a view of the reader's buffer.
+                frames = frames * placement.volume
+            # Mono sources are spread over all channels.
+            out[mask] += frames if frames.shape[1] == self.nchannels else frames[:, :1]
+        return out[0] if scalar else out
 
 
-def generate_silent_audio(duration, fps=44100, nchannels=2):
-    samples_per_frame = int(fps * duration)
-    audio_data = np.zeros((samples_per_frame, nchannels))
-    silent_clip = AudioArrayClip(audio_data, fps=fps)
-    return silent_clip
+class _Placement:
+    def __init__(self, source, start, end, source_start, volume):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.source_start = source_start
+        self.volume = volume
@@ -0,0 +1,162 @@
+import math
+import unicodedata
+from functools import lru_cache
+
+from PIL import ImageFont
+
+# Closing punctuation, never moved to the start of a line away from the text it closes.
+NO_LINE_START = frozenset("，。！？、；：”’）》」』】,.!?;:)]}%")
+
+
+# Fonts are laid out with Pillow's basic layout, the layout GlyphMetrics measures, whether libraqm is installed or
+# not. Every font is loaded only once per process.
+@lru_cache(maxsize=32)
+def get_font(font, font_size):
+    return ImageFont.truetype(font, font_size, layout_engine=ImageFont.Layout.BASIC)
+
+
+class GlyphMetrics:
+    """
+    Advance widths, kerning and ink boxes of the glyphs of a font, measured once per process and character.
+
+    Lines are measured from them the way Pillow lays out text: every glyph is drawn at the pen position rounded to the
+    pixel, and the pen advances by the exact advance and kerning. A line measured from the cached glyphs gets the
+    box font.getbbox gives it, to the pixel, without laying the line out.
+    """
+
+    def __init__(self, font, font_size):
+        self.font = get_font(font, font_size)
+        self.font_size = font_size
+        self._glyphs = {}
+        self._kerning = {}
+        self._line_spacing = {}
+
+    def glyph(self, char):
+        # (advance, left, top, right, bottom), the box relative to the pen at the middle of the line.
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            glyph = (self.font.getlength(char), *self.font.getbbox(char, anchor="lm"))
+            self._glyphs[char] = glyph
+        return glyph
+
+    def kerning(self, left, right):
+        pair = left + right
+        kerning = self._kerning.get(pair)
+        if kerning is None:
+            kerning = self.font.getlength(pair) - self.glyph(left)[0] - self.glyph(right)[0]
+            self._kerning[pair] = kerning
+        return kerning
+
+    def em_width(self, char):
+        """
+        The advance of ``char`` in multiples of the font size.
+        """
+        return self.glyph(char)[0] / self.font_size
+
+    def line_spacing(self, spacing, stroke_width):
+        # The distance between lines of multiline text, as Pillow spaces them.
+        key = (spacing, stroke_width)
+        if key not in self._line_spacing:
+            self._line_spacing[key] = self.font.getbbox("A", stroke_width=stroke_width)[3] + stroke_width + spacing
+        return self._line_spacing[key]
+
+
+@lru_cache(maxsize=32)
+def get_glyph_metrics(font, font_size) -> GlyphMetrics:
+    return GlyphMetrics(font, font_size)
+
+
+class CaptionLayout:
+    """
+    The lines of a caption and the box of the text drawn with ImageDraw.multiline_text at (0, 0), anchor "lm".
+    """
+
+    def __init__(self, lines, box):
+        self.lines = lines
+        self.text = "\n".join(lines)
+        self.box = box
+        left, top, right, bottom = box
+        self.size = (int(right - left), int(bottom - top))
+
+
+# The state of a line being measured: (pen, left, top, right, bottom, last character).
+_EMPTY_LINE = (0, 0, math.inf, 0, -math.inf, None)
+
+
+def layout_caption(text, font, font_size, width, stroke_width=0, spacing=4, align="center") -> CaptionLayout:
+    """
+    Break ``text`` into lines no wider than ``width`` and measure its box, in one pass over the characters.
+
+    The lines of the text are kept and broken further where they overflow: at the last space, or between wide (CJK)
+    characters, never before closing punctuation, and anywhere in a word wider than the line.
+    """
+    metrics = get_glyph_metrics(font, font_size)
+    lines = []
+    for paragraph in text.split("\n"):
+        lines.extend(_wrap(metrics, paragraph, width, stroke_width))
+
+    line_spacing = metrics.line_spacing(spacing, stroke_width)
+    max_pen = max(state[0] for _, state in lines)
+    top = -(len(lines) - 1) * line_spacing / 2
+    box = None
+    for _, state in lines:
+        # Aligned within the widest line, like multiline_textbbox.
+        offset = {"left": 0, "center": (max_pen - state[0]) / 2, "right": max_pen - state[0]}[align]
+        left, line_top, right, bottom = _line_box(state, stroke_width)
+        line_box = (left + offset, line_top + top, right + offset, bottom + top)
+        box = line_box if box is None else (min(box[0], line_box[0]), min(box[1], line_box[1]),
+                                            max(box[2], line_box[2]), max(box[3], line_box[3]))
+        top += line_spacing
+    return CaptionLayout([line for line, _ in lines], box)
+
+
+def _wrap(metrics, paragraph, width, stroke_width):
+    lines = []
+    start = 0
+    state = _EMPTY_LINE
+    # The last break opportunity of the line: (end of the line, start of the next line, state at the end).
+    line_break = None
+    i = 0
+    while i < len(paragraph):
+        char = paragraph[i]
+        if i > start:
+            if char == " ":
+                line_break = (i, i + 1, state)
+            elif char not in NO_LINE_START and (_is_wide(char) or _is_wide(paragraph[i - 1])):
+                line_break = (i, i, state)
+        measured = _add_glyph(metrics, state, char)
+        left, _, right, _ = _line_box(measured, stroke_width)
+        if i > start and right - left > width:
+            end, next_start, line_state = line_break or (i, i, state)
+            lines.append((paragraph[start:end], line_state))
+            # The characters after the break start the next line and are measured again.
+            start = i = next_start
+            state = _EMPTY_LINE
+            line_break = None
+            continue
+        state = measured
+        i += 1
+    lines.append((paragraph[start:], state))
+    return lines
+
+
+def _add_glyph(metrics, state, char):
+    pen, left, top, right, bottom, last = state
+    advance, glyph_left, glyph_top, glyph_right, glyph_bottom = metrics.glyph(char)
+    if last is not None:
+        pen += metrics.kerning(last, char)
+    x = math.floor(pen + 0.5)
+    return (pen + advance, min(left, x + glyph_left), min(top, glyph_top), max(right, x + glyph_right),
+            max(bottom, glyph_bottom), char)
+
+
+def _line_box(state, stroke_width):
+    pen, left, top, right, bottom, last = state
+    if last is None:
+        return -stroke_width, -stroke_width, stroke_width, stroke_width
+    return (left - stroke_width, top - stroke_width, max(right, math.floor(pen + 0.5)) + stroke_width,
+            bottom + stroke_width)
+
+
+def _is_wide(char):
+    return unicodedata.east_asian_width(char) in "WF"
@@ -0,0 +1,108 @@
+from bisect import bisect_right
+
+import numpy as np
+
+from utils.caption_renderer import scale_caption
+
+
+class CaptionOverlay:
+    """
+    Burns caption sprites into the frames of a clip in a single pass.
+
+    Captions are kept sorted by start time together with the running maximum of their end times, so the captions
+    active at ``t`` are found with one bisect and a short backwards scan instead of checking every caption layer.
+    Frames are blended into one preallocated buffer: a returned frame is only valid until the next frame is made.
+
+    Captions are laid out on a frame of ``layout_size``, the size of the full resolution render, and drawn scaled by
+    ``scale``, so a preview on proxies shows them exactly where the final render puts them.
+    """
+
+    def __init__(self, scale=1.0, layout_size=None):
+        self.scale = scale
+        self.layout_size = layout_size
+        self._captions = []
+        self._index = None
+
+    def frame_size(self, size):
+        """
+        The frame size captions are laid out on, for frames of ``size``.
+        """
+        return tuple(self.layout_size or size)
+
+    def add(self, sprite, start, end, pos):
+        if end <= start:
+            return
+        if self.scale != 1:
+            sprite = scale_caption(sprite, self.scale)
+            pos = (pos[0] * self.scale, pos[1] * self.scale)
+        self._captions.append((start, end, int(pos[0]), int(pos[1]), sprite))
+        self._index = None
+
+    def apply(self, video_clip):
+        if not self._captions:
+            return video_clip
+        self._build_index()
+        buffer = np.empty((video_clip.size[1], video_clip.size[0], 3), dtype=np.uint8)
+        return video_clip.transform(lambda get_frame, t: self.blend(get_frame(t), t, buffer), apply_to=[])
+
+    def captions(self):
+        """
+        The captions as (start, end, x, y, sprite) on the frame, by start time.
+        """
+        return sorted(self._captions, key=lambda c: c[0])
+
+    def boundaries(self):
+        """
+        The times where the visible captions change.
+        """
+        return sorted({time for start, end, *_ in self._captions for time in (start, end)})
+
+    def active(self, t):
+        self._build_index()
+        starts, max_ends, entries = self._index
+        active = []
+        i = bisect_right(starts, t) - 1
+        # Entries before i with a running maximum end <= t cannot be active.
+        while i >= 0 and max_ends[i] > t:
+            if entries[i].end > t:
+                active.append(entries[i])
+            i -= 1
+        active.reverse()
+        return active
+
+    def blend(self, frame, t, buffer):
+        active = self.active(t)
+        if not active:
+            return frame
+        np.copyto(buffer, frame[:, :, :3], casting="unsafe")
+        height, width = buffer.shape[:2]
+        for entry in active:
+            sprite_width, sprite_height = entry.sprite.size
+            # Clip the sprite to the frame.
+            x0, y0 = max(entry.x, 0), max(entry.y, 0)
+            x1, y1 = min(entry.x + sprite_width, width), min(entry.y + sprite_height, height)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            sx, sy = x0 - entry.x, y0 - entry.y
+            region = buffer[y0:y1, x0:x1]
+            blended = region * entry.sprite.inverse_alpha[sy:sy + y1 - y0, sx:sx + x1 - x0]
+            blended += entry.sprite.premultiplied[sy:sy + y1 - y0, sx:sx + x1 - x0]
+            np.copyto(region, blended, casting="unsafe")
+        return buffer
+
+    def _build_index(self):
+        if self._index is not None:
+            return
+        entries = [_OverlayEntry(*caption) for caption in sorted(self._captions, key=lambda c: c[0])]
+        starts = [entry.start for entry in entries]
+        max_ends = list(np.maximum.accumulate([entry.end for entry in entries]))
+        self._index = (starts, max_ends, entries)
+
+
+class _OverlayEntry:
+    def __init__(self, start, end, x, y, sprite):
+        self.start = start
+        self.end = end
+        self.x = x
+        self.y = y
+        self.sprite = sprite
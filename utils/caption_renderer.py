@@ -0,0 +1,62 @@
+from functools import lru_cache, cached_property
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from config.common_config import CAPTION_SPRITE_CACHE_SIZE
+from utils.caption_layout import get_font, layout_caption
+
+# Line spacing of moviepy's TextClip.
+INTERLINE = 4
+
+
+class CaptionSprite:
+    def __init__(self, rgb, mask):
+        self.rgb = rgb
+        self.mask = mask
+        self.size = (rgb.shape[1], rgb.shape[0])
+
+    # Blending terms, computed once per sprite: frame * inverse_alpha + premultiplied.
+    @cached_property
+    def inverse_alpha(self):
+        return 1 - self.mask[:, :, None]
+
+    @cached_property
+    def premultiplied(self):
+        return self.rgb * self.mask[:, :, None]
+
+
+# Render a caption like TextClip(method='caption', size=(width, None)), laid out from cached glyph metrics in a single
+# pass. The sprites are shared between clips and must not be modified.
+@lru_cache(maxsize=CAPTION_SPRITE_CACHE_SIZE)
+def render_caption(text, font, font_size, width, color, stroke_color, stroke_width, text_align) -> CaptionSprite:
+    pil_font = get_font(font, font_size)
+    layout = layout_caption(text, font, font_size, width, stroke_width, INTERLINE, text_align)
+    text = layout.text
+    text_width, text_height = layout.size
+    img = Image.new("RGBA", (width, text_height), color=(0, 0, 0, 0))
+    ImageDraw.Draw(img).multiline_text(xy=((width - text_width) / 2, text_height / 2), text=text, fill=color,
+                                       font=pil_font, spacing=INTERLINE, align=text_align,
+                                       stroke_width=stroke_width, stroke_fill=stroke_color, anchor="lm")
+    rgba = np.array(img)
+    rgb = np.ascontiguousarray(rgba[:, :, :3])
+    mask = rgba[:, :, 3].astype(np.float32) / 255
+    rgb.flags.writeable = False
+    mask.flags.writeable = False
+    return CaptionSprite(rgb, mask)
+
+
+
+# Scale a caption laid out for the full resolution frame onto a proxy frame.
+@lru_cache(maxsize=CAPTION_SPRITE_CACHE_SIZE)
+def scale_caption(sprite, scale) -> CaptionSprite:
+    width, height = sprite.size
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    alpha = np.round(sprite.mask * 255).astype(np.uint8)
+    img = Image.fromarray(np.dstack([sprite.rgb, alpha]), "RGBA").resize(size, resample=Image.LANCZOS)
+    rgba = np.array(img)
+    rgb = np.ascontiguousarray(rgba[:, :, :3])
+    mask = rgba[:, :, 3].astype(np.float32) / 255
+    rgb.flags.writeable = False
+    mask.flags.writeable = False
+    return CaptionSprite(rgb, mask)
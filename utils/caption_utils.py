@@ -2,15 +2,23 @@ import re
 
 import regex
 
+# Patterns compiled once per process.
+# Split after periods and other sentence-ending punctuation, except inside quotes.
+SENTENCE_END_PATTERN = re.compile(r'(?<=[。！？])(?![^“”]*”)\s*')
+# Everything but Chinese and English characters and digits.
+NOT_COUNTED_PATTERN = regex.compile(r'[^\p{L}\p{Nd}\p{Han}]')
+# Non-word characters (i.e., punctuation).
+PUNCTUATION_PATTERN = re.compile(r"\W")
+
 
 # split caption
 def split_caption(text, duration):
     # Use regular expressions to get a list of subtitles split by periods and other punctuation marks.
-    segments = re.split(r'(?<=[。！？])(?![^“”]*”)\s*', text)
+    segments = SENTENCE_END_PATTERN.split(text)
     # Remove empty segments
     segments = [seg for seg in segments if seg]
     # Calculate the number of Chinese and English characters in each paragraph (removing punctuation)
-    cjk_and_english_counts = [len(regex.sub(r'[^\p{L}\p{Nd}\p{Han}]', '', seg)) for seg in segments]
+    cjk_and_english_counts = [len(NOT_COUNTED_PATTERN.sub('', seg)) for seg in segments]
     # Calculate the total number of Chinese and English characters
     total_cjk_and_english_count = sum(cjk_and_english_counts)
     # Allocate time based on the number of Chinese and English characters
@@ -28,13 +36,10 @@ def add_newlines(text, max_length=38):
     # Last split position
     last_cut = 0
 
-    # Regular expression to match non-word characters
-    punctuation_pattern = r"\W"
-
     # Insert a possible newline character after each non-word character (i.e., punctuation)
     for i, char in enumerate(text):
         # The last non-word character before the cumulative length reaches max_length
-        if re.match(punctuation_pattern, char) and current_length >= max_length:
+        if PUNCTUATION_PATTERN.match(char) and current_length >= max_length:
             result.append(text[last_cut:i + 1] + '\n')
             last_cut = i + 1
             current_length = 0
@@ -53,26 +58,30 @@ def add_newlines(text, max_length=38):
     return ''.join(result).strip()
 
 
-def split_text_display(text, max_length=15):
+# Estimated width of a character, in Chinese characters.
+def estimate_char_size(c):
+    if ord(c) > 127:
+        size = 1
+    else:
+        size = 0.5
+    return size
+
+
+# Break the text into display lines of max_length Chinese characters. char_size gives the width of a character in
+# Chinese characters, measured from the caption font with GlyphMetrics.em_width, estimated without it.
+def split_text_display(text, max_length=15, char_size=estimate_char_size):
     def word_cn_size(text):
         len = 0
         for c in text:
-            len += get_char_size(c)
+            len += char_size(c)
         return len
 
-    def get_char_size(c):
-        if ord(c) > 127:
-            size = 1
-        else:
-            size = 0.5
-        return size
-
     def split_lines(str, max_length):
         num = 0
         result = []
         for char in str:
             result.append(char)
-            num += get_char_size(char)
+            num += char_size(char)
             if num >= max_length:
                 result.append('\n')
                 num = 0
@@ -92,7 +101,7 @@ def split_text_display(text, max_length=15):
     index = 0
     pos = 0
     for i, char in enumerate(text):
-        index += get_char_size(char)
+        index += char_size(char)
         if index >= split_pos:
             pos = i
             break
@@ -1,22 +1,201 @@
 import logging
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 
+from moviepy import VideoFileClip, AudioFileClip
+
+from config.common_config import MAX_OPEN_READERS
+from utils import metrics
+
 logger = logging.getLogger(__name__)
 
 
-@contextmanager
-def clean_clips():
-    clips = []
+class ClipCleaner:
+    """
+    Collects the clips created during a render and closes them at the end. Calling it registers a clip.
 
-    def add_2_clean(c):
-        clips.append(c)
+    File readers are opened once per file and shared by all pipeline stages of the render, every reader is an
+    ffmpeg subprocess. At most ``max_open_readers`` of them are kept open: beyond that the least recently read ones
+    are released, their subprocess freed, and reopened on their next read. Shots are read in timeline
+    order, so the readers of the shots already written are the ones released, and the open readers stay bounded
+    however long the timeline is.
+    """
+
+    def __init__(self, max_open_readers=MAX_OPEN_READERS):
+        self.clips = []
+        self.max_open_readers = max_open_readers
+        self.peak_open_readers = 0
+        self._readers = {}
+        # Reader slots from the least to the most recently read.
+        self._slots = OrderedDict()
+        self._open_readers = 0
+        self._reopened = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, c):
+        self.clips.append(c)
         return c
 
-    try:
-        yield add_2_clean
-    finally:
-        for clip in clips:
+    def open_video(self, path, audio=True):
+        key = ("video", path, audio)
+        if key not in self._readers:
+            clip = self(VideoFileClip(path, audio=audio))
+            clip.reader = ReaderSlot(self, clip.reader, "video")
+            if clip.audio is not None:
+                clip.audio.reader = ReaderSlot(self, clip.audio.reader, "audio")
+            self._readers[key] = clip
+        return self._readers[key]
+
+    def open_audio(self, path):
+        key = ("audio", path)
+        if key not in self._readers:
+            clip = self(AudioFileClip(path))
+            clip.reader = ReaderSlot(self, clip.reader, "audio")
+            self._readers[key] = clip
+        return self._readers[key]
+
+    def close(self):
+        for clip in self.clips:
             try:
                 clip.close()
             except Exception as e:
                 logger.error("close clip failed, error: %s", e, exc_info=True)
+        if self._slots:
+            logger.info("clip readers closed, readers: %s, peak open: %s, reopened: %s", len(self._slots),
+                        self.peak_open_readers, self._reopened)
+        self.clips.clear()
+        self._readers.clear()
+        self._slots.clear()
+
+    def _opened(self, slot, reopened=False):
+        with self._lock:
+            self._slots[slot] = None
+            self._slots.move_to_end(slot)
+            self._open_readers += 1
+            self._reopened += reopened
+            self.peak_open_readers = max(self.peak_open_readers, self._open_readers)
+        metrics.inc("clip_reader_opens_total", kind=slot.kind, reason="reopen" if reopened else "open")
+        self._release_idle(slot)
+
+    def _read(self, slot):
+        with self._lock:
+            self._slots.move_to_end(slot)
+
+    def _closed(self):
+        with self._lock:
+            self._open_readers -= 1
+
+    def _release_idle(self, keep):
+        with self._lock:
+            excess = self._open_readers - self.max_open_readers
+            candidates = [slot for slot in self._slots if slot is not keep and slot.is_open]
+        for slot in candidates:
+            if excess <= 0:
+                break
+            # A reader in the middle of a read on another thread is skipped, the cap is exceeded until its next
+            # release.
+            if slot.release():
+                excess -= 1
+                metrics.inc("clip_reader_releases_total", kind=slot.kind)
+
+
+class ReaderSlot:
+    """
+    A moviepy file reader under the cap of a ClipCleaner, in place of the ``reader`` of its clip. Clips derived from
+    a file clip read through the reader of the file clip, so all of them go through the slot.
+
+    A released reader is reopened in the state it was released in, so what it reads does not depend on whether it
+    was released: moviepy seeks by reinitializing a reader at a time, which does not always land on the frame
+    sequential reading gets to, so the reader is reinitialized at its last seek and read forward to its position.
+    A read that seeks anyway just seeks.
+    """
+
+    def __init__(self, cleaner, reader, kind):
+        self.cleaner = cleaner
+        self.reader = reader
+        self.kind = kind
+        self.is_open = True
+        # Where moviepy last initialized the reader, at 0 when it was created.
+        self.seek_time = 0
+        self._initialize = reader.initialize
+        reader.initialize = self._seek
+        self._lock = threading.Lock()
+        cleaner._opened(self)
+
+    def get_frame(self, t):
+        reopened = False
+        with self._lock:
+            if not self.is_open:
+                self._reopen(t)
+                reopened = True
+            frame = self.reader.get_frame(t)
+        if reopened:
+            self.cleaner._opened(self, reopened=True)
+        else:
+            self.cleaner._read(self)
+        return frame
+
+    def release(self) -> bool:
+        """
+        Close the reader until its next read, False if it is being read.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if not self.is_open:
+                return False
+            self._close()
+            return True
+        finally:
+            self._lock.release()
+
+    def close(self):
+        with self._lock:
+            if self.is_open:
+                self._close()
+
+    def _seek(self, start_time=0):
+        self.seek_time = start_time
+        self._initialize(start_time)
+
+    def _close(self):
+        # Only the subprocess is freed. The position, the last frame of a video reader (returned again past the end
+        # of the file) and the buffer of an audio reader, a couple of seconds of samples, are kept.
+        if self.kind == "audio":
+            self.reader.close()
+        else:
+            self.reader.close(delete_lastread=False)
+        self.is_open = False
+        self.cleaner._closed()
+
+    def _reopen(self, t):
+        pos = self.reader.pos
+        if self.kind == "audio":
+            # The buffer is untouched, the stream is read forward to where it was.
+            self._initialize(self.seek_time)
+            while self.reader.pos < pos:
+                self.reader.skip_chunk(int(min(pos - self.reader.pos, self.reader.buffersize)))
+        else:
+            last_read = self.reader.last_read
+            frame_pos = self.reader.get_frame_number(t) + 1
+            if frame_pos < pos or frame_pos > pos + 100:
+                # The read would seek, as FFMPEG_VideoReader.get_frame does.
+                self._seek(t)
+            else:
+                self._initialize(self.seek_time)
+                self.reader.skip_frames(pos - self.reader.pos)
+                self.reader.last_read = last_read
+        self.is_open = True
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+
+@contextmanager
+def clean_clips():
+    clip_cleaner = ClipCleaner()
+    try:
+        yield clip_cleaner
+    finally:
+        clip_cleaner.close()
@@ -0,0 +1,92 @@
+import logging
+import os
+import subprocess
+import tempfile
+
+from moviepy.config import FFMPEG_BINARY
+
+logger = logging.getLogger(__name__)
+
+
+def run_ffmpeg(args, on_progress=None):
+    """
+    Run ffmpeg. ``on_progress`` is called with the number of frames written so far, an exception raised by it kills
+    ffmpeg and is re-raised.
+    """
+    cmd = [FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error", *args]
+    if on_progress is None:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        returncode, error = result.returncode, result.stderr
+    else:
+        cmd[1:1] = ["-progress", "pipe:1", "-nostats"]
+        # stderr goes to a file, a full stderr pipe would block ffmpeg while only stdout is read.
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                for line in process.stdout:
+                    key, _, value = line.decode("utf-8", errors="replace").strip().partition("=")
+                    if key == "frame" and value.isdigit():
+                        on_progress(int(value))
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            finally:
+                process.stdout.close()
+            returncode = process.wait()
+            stderr.seek(0)
+            error = stderr.read()
+    if returncode != 0:
+        error = error.decode("utf-8", errors="replace").strip()
+        raise RuntimeError(f"ffmpeg failed, code: {returncode}, error: {error}")
+
+
+def write_concat_list(paths, list_path):
+    with open(list_path, "w", encoding="utf-8") as f:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    return list_path
+
+
+# Join segments without re-encoding the video, then mix the looped bgm into the concatenated audio.
+def concat_segments(segment_paths, output_path, bgm_path, bgm_volume, audio_bitrate=None, faststart=True):
+    list_path = write_concat_list(segment_paths, os.path.splitext(segment_paths[0])[0] + "_concat.txt")
+    inputs = ["-f", "concat", "-safe", "0", "-i", list_path]
+    # The concat filter converts the audio of the segments to a common channel layout and sample rate.
+    for segment_path in segment_paths:
+        inputs += ["-i", segment_path]
+    inputs += ["-stream_loop", "-1", "-i", bgm_path]
+    bgm_index = len(segment_paths) + 1
+    voices = "".join(f"[{i}:a]" for i in range(1, bgm_index))
+    filter_complex = (f"{voices}concat=n={len(segment_paths)}:v=0:a=1[voice];"
+                      f"[{bgm_index}:a]volume={bgm_volume}[bgm];"
+                      f"[voice][bgm]amix=inputs=2:duration=first:normalize=0[audio]")
+    output_args = ["-c:v", "copy", "-c:a", "aac"]
+    if audio_bitrate:
+        output_args += ["-b:a", audio_bitrate]
+    if faststart:
+        output_args += ["-movflags", "+faststart"]
+    run_ffmpeg([*inputs, "-filter_complex", filter_complex, "-map", "0:v", "-map", "[audio]", *output_args,
+                output_path])
+    return output_path
+
+
+def count_ffmpeg_processes():
+    """
+    Number of running ffmpeg processes of the bundled binary, read from /proc. None where /proc is not available.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    binary = os.fsencode(FFMPEG_BINARY)
+    count = 0
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "cmdline"), "rb") as f:
+                if f.read().split(b"\0", 1)[0] == binary:
+                    count += 1
+        except OSError:
+            continue
+    return count
@@ -1,12 +1,30 @@
+import hashlib
 import logging
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse, unquote
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from config.common_config import DOWNLOAD_WORKERS_PER_TASK, DOWNLOAD_POOL_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_RETRIES, \
+    DOWNLOAD_BACKOFF, DOWNLOAD_CHUNK_SIZE, TASK_MATERIAL_DIR
+from utils.job_context import JobCancelled
+from utils.material_cache import get_material_cache
 
 logger = logging.getLogger(__name__)
 
+# Shared keep-alive connection pool, requests sessions are safe to share between download threads.
+_session = None
+_session_lock = threading.Lock()
+
+
+class RetryableDownloadError(Exception):
+    pass
+
 
 def get_filename_from_url(url):
     # parse url
@@ -39,20 +57,127 @@ def get_filename(url, response):
     return get_filename_from_cd(cd) or get_filename_from_url(url)
 
 
-def download(url, sub_path, path="./tmp/data/omni-editor/download/{sub_path}/"):
+def download(url, sub_path, path=TASK_MATERIAL_DIR, context=None):
+    path = path.format(task_id=sub_path)
+    cache = get_material_cache()
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            path = path.format(sub_path=sub_path)
-            os.makedirs(path, exist_ok=True)
-            file_name = get_filename(url, response)
-            filepath = os.path.join(path, file_name)
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            logger.info("file download success, url: %s, sub_path: %s", url, sub_path)
-            return filepath
-        else:
-            raise ValueError(f"file download failed  code != 200, url: {url}, sub_path: {sub_path}")
+        # Only one worker downloads a url at a time, the others wait and reuse its cache entry.
+        with cache.lock(url):
+            entry = cache.lookup(url)
+            if entry is not None and cache.is_fresh(entry):
+                cache.hit()
+            else:
+                entry = _fetch(url, entry, context)
+            try:
+                filepath = cache.link(entry, path)
+            except FileNotFoundError:
+                # The blob has been evicted since the lookup.
+                filepath = cache.link(_fetch(url, None, context), path)
+        logger.info("file download success, url: %s, sub_path: %s", url, sub_path)
+        return filepath
+    except JobCancelled:
+        raise
     except Exception as e:
         logger.error("file download failed, url: %s, sub_path: %s", url, sub_path, exc_info=True)
         raise e
+
+
+def download_all(urls, sub_path, max_workers=DOWNLOAD_WORKERS_PER_TASK, context=None) -> dict:
+    """
+    Download the urls concurrently, return a dict of url -> local file path.
+    """
+    urls = list(dict.fromkeys(url for url in urls if url))
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls)), thread_name_prefix="download") as executor:
+        futures = {executor.submit(download, url, sub_path, context=context): url for url in urls}
+        try:
+            files = {}
+            for future in as_completed(futures):
+                files[futures[future]] = future.result()
+                if context is not None:
+                    context.report("download", len(files), len(urls))
+            return files
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def get_content_hash(url, filepath):
+    """
+    The sha256 of a downloaded file, taken from the material cache if the file is still linked to its blob.
+    """
+    cache = get_material_cache()
+    entry = cache.lookup(url)
+    if entry is not None and cache.contains(entry, filepath):
+        return entry.sha256
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE, pool_maxsize=DOWNLOAD_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _fetch(url, entry, context=None):
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return _fetch_once(url, entry, context)
+        except RetryableDownloadError as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise e
+            backoff = DOWNLOAD_BACKOFF * 2 ** attempt
+            logger.warning("file download retry in %ss, url: %s, error: %s", backoff, url, e)
+            time.sleep(backoff)
+
+
+def _fetch_once(url, entry, context=None):
+    """
+    Fetch the url into the material cache, revalidating ``entry`` with a conditional GET if there is one.
+    """
+    cache = get_material_cache()
+    headers = {}
+    if entry is not None:
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+    try:
+        with _get_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            if response.status_code == 304 and entry is not None:
+                return cache.revalidated(entry)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise RetryableDownloadError(f"file download failed code {response.status_code}, url: {url}")
+            if response.status_code != 200:
+                raise ValueError(f"file download failed  code != 200, url: {url}")
+            # Stream into a temporary file, so a failed download never leaves a truncated material behind.
+            tmp_path = cache.new_temp_path()
+            sha256 = hashlib.sha256()
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if context is not None:
+                            context.check_cancelled()
+                        sha256.update(chunk)
+                        f.write(chunk)
+                return cache.store(url, tmp_path, get_filename(url, response), sha256.hexdigest(),
+                                   etag=response.headers.get("ETag"),
+                                   last_modified=response.headers.get("Last-Modified"))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+        raise RetryableDownloadError(str(e)) from e
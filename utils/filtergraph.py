@@ -0,0 +1,169 @@
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+from utils.ffmpeg_utils import run_ffmpeg
+
+AUDIO_FPS = 44100
+
+
+class FiltergraphShot:
+    """
+    One shot of a filtergraph render, on a timeline of ``duration`` seconds.
+
+    The picture is the image ``img``, or the video ``video`` of ``video_fps`` frames per second after its first
+    frame has been held for ``hold`` seconds. ``audio`` plays from ``audio_start`` and is cut at the end of the shot, the shot is silent without it.
+    ``captions`` are (start, end, x, y, CaptionSprite) on the canvas, as laid out by CaptionOverlay.
+    """
+
+    def __init__(self, duration, img=None, video=None, video_fps=None, hold=0, audio=None, audio_start=0,
+                 captions=()):
+        self.duration = duration
+        self.img = img
+        self.video = video
+        self.video_fps = video_fps
+        self.hold = hold
+        self.audio = audio
+        self.audio_start = audio_start
+        self.captions = list(captions)
+
+
+class Filtergraph:
+    """
+    Compiles shots into a single ffmpeg invocation, no frame passes through Python.
+
+    Frames are sampled like moviepy writes a clip: frame n shows the timeline at n / fps, so every shot gets the same
+    frames, and every caption the same frames, as in a moviepy render. Shots are centered on the canvas, cropped or
+    padded like a centered composite. The shot tracks are concatenated at their exact durations and mixed with the
+    looped bgm.
+    """
+
+    def __init__(self, shots, bgm, bgm_volume, size, fps, scratch_dir):
+        self.shots = shots
+        self.bgm = bgm
+        self.bgm_volume = bgm_volume
+        self.size = size
+        self.fps = fps
+        self.scratch_dir = scratch_dir
+        self.inputs = []
+        self.filters = []
+        self._sprite_paths = {}
+
+    @property
+    def total_frames(self) -> int:
+        return int(sum(shot.duration for shot in self.shots) * self.fps)
+
+    def render(self, output_path, output_args, output_size=None, on_progress=None) -> int:
+        """
+        Write the render to ``output_path`` and return the number of frames. ``on_progress`` is called with the
+        frames written so far and the total.
+        """
+        video_labels, audio_labels = [], []
+        start = 0
+        first_frame = 0
+        total_frames = self.total_frames
+        for index, shot in enumerate(self.shots):
+            end = start + shot.duration
+            # The frames n with start <= n / fps < end.
+            end_frame = min(_ceil_frames(end, self.fps), total_frames)
+            # The first frame of the shot shows the shot at phase, not at 0.
+            phase = first_frame / self.fps - start
+            video_labels.append(self._add_shot_video(index, shot, end_frame - first_frame, phase))
+            audio_labels.append(self._add_shot_audio(index, shot))
+            start, first_frame = end, end_frame
+
+        count = len(self.shots)
+        self.filters.append(f"{''.join(video_labels)}concat=n={count}:v=1:a=0[video]")
+        self.filters.append(f"{''.join(audio_labels)}concat=n={count}:v=0:a=1[voice]")
+        bgm_index = self._add_input("-stream_loop", "-1", "-i", self.bgm)
+        self.filters.append(f"[{bgm_index}:a:0]{_audio_format()},volume={self.bgm_volume}[bgm]")
+        self.filters.append("[voice][bgm]amix=inputs=2:duration=first:normalize=0[audio]")
+        scale = f"scale={output_size[0]}:{output_size[1]}," if output_size and tuple(output_size) != tuple(
+            self.size) else ""
+        self.filters.append(f"[video]{scale}format=yuv420p[out]")
+
+        args = [*self.inputs, "-filter_complex", ";".join(self.filters), "-map", "[out]", "-map", "[audio]",
+                "-r", str(self.fps), *output_args, output_path]
+        progress = None if on_progress is None else lambda frame: on_progress(min(frame, total_frames), total_frames)
+        run_ffmpeg(args, progress)
+        return total_frames
+
+    def _add_shot_video(self, index, shot, frames, phase):
+        width, height = self.size
+        if shot.video:
+            source = self._add_input("-i", shot.video)
+            chain = [f"[{source}:v:0]"]
+            shift = phase
+            if shot.hold > 0:
+                # Padded by whole frames of the video, ahead of any setpts, which drops the frame rate tpad needs.
+                # The frames held too long are shifted out of the shot.
+                pad_frames = math.ceil(shot.hold * shot.video_fps)
+                chain[0] += f"tpad=start={pad_frames}:start_mode=clone,"
+                shift += pad_frames / shot.video_fps - shot.hold
+            chain[0] += f"setpts=PTS-STARTPTS-{shift:.6f}/TB"
+            # Input timestamps rounded up, so frame n shows the last frame of the video at or before n / fps.
+            chain.append(f"fps={self.fps}:start_time=0:round=up")
+        else:
+            source = self._add_input("-i", shot.img)
+            # The image is decoded once and repeated.
+            chain = [f"[{source}:v:0]loop=loop=-1:size=1:start=0", f"setpts=N/{self.fps}/TB"]
+        chain.append("tpad=stop=-1:stop_mode=clone")
+        chain.append(f"trim=end_frame={frames}")
+        chain.append("setpts=PTS-STARTPTS")
+        # Centered on the canvas.
+        chain.append(f"crop='min(iw,{width})':'min(ih,{height})'")
+        chain.append(f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2")
+        label = f"[v{index}]"
+        if not shot.captions:
+            self.filters.append(",".join(chain) + label)
+            return label
+        # Captions are blended in RGB like the moviepy overlay.
+        chain.append("format=rgb24")
+        current = f"[v{index}base]"
+        self.filters.append(",".join(chain) + current)
+        for caption_index, (start, end, x, y, sprite) in enumerate(shot.captions):
+            sprite_input = self._add_input("-i", self._sprite_path(sprite))
+            output = label if caption_index == len(shot.captions) - 1 else f"[v{index}c{caption_index}]"
+            enable = f"gte(t,{start - phase:.6f})*lt(t,{end - phase:.6f})"
+            self.filters.append(f"{current}[{sprite_input}:v:0]overlay=x={x}:y={y}:format=rgb:eof_action=repeat:"
+                                f"enable='{enable}'{output}")
+            current = output
+        return label
+
+    def _add_shot_audio(self, index, shot):
+        label = f"[a{index}]"
+        if shot.audio is None:
+            self.filters.append(f"anullsrc=r={AUDIO_FPS}:cl=stereo,atrim=end={shot.duration:.6f}{label}")
+            return label
+        source = self._add_input("-i", shot.audio)
+        delay = round(shot.audio_start * AUDIO_FPS)
+        self.filters.append(f"[{source}:a:0]asetpts=PTS-STARTPTS,{_audio_format()},adelay=delays={delay}S:all=1,"
+                            f"apad,atrim=end={shot.duration:.6f},asetpts=PTS-STARTPTS{label}")
+        return label
+
+    def _add_input(self, *args) -> int:
+        index = sum(1 for arg in self.inputs if arg == "-i")
+        self.inputs.extend(args)
+        return index
+
+    def _sprite_path(self, sprite):
+        # Every sprite is written once, repeated captions share the sprite.
+        path = self._sprite_paths.get(id(sprite))
+        if path is None:
+            path = os.path.join(self.scratch_dir, f"caption_{len(self._sprite_paths)}.png")
+            alpha = np.round(sprite.mask * 255).astype(np.uint8)
+            Image.fromarray(np.dstack([sprite.rgb, alpha]), "RGBA").save(path, compress_level=1)
+            self._sprite_paths[id(sprite)] = path
+        return path
+
+
+def _audio_format():
+    # The audio of moviepy clips is read as 44.1 kHz stereo.
+    return f"aformat=sample_fmts=fltp:sample_rates={AUDIO_FPS}:channel_layouts=stereo"
+
+
+def _ceil_frames(t, fps):
+    # Rounded first, so a boundary on a frame time is not pushed to the next frame by float error.
+    return math.ceil(round(t * fps, 6))
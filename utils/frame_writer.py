@@ -0,0 +1,136 @@
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+import proglog
+from moviepy.tools import find_extension
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+from config.common_config import FRAME_RING_SIZE
+from utils.ffmpeg_utils import run_ffmpeg
+from utils.job_context import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+# Audio track settings, the defaults of moviepy's write_videofile.
+AUDIO_FPS = 44100
+AUDIO_NBYTES = 4
+AUDIO_BUFFERSIZE = 2000
+
+
+class FrameRingWriter:
+    """
+    Writes a clip with frame production and encoding overlapped, in place of moviepy's write_videofile.
+
+    A producer thread renders the frames into a ring of ``ring_size`` preallocated buffers while the calling thread
+    feeds the filled ones to the encoder pipe as memoryviews, without copying them again, so frame n + 1 is decoded
+    and composited while frame n is encoded. The memory of a write is capped at the ring whatever the length of the
+    clip. The audio is rendered to its own track on another thread meanwhile, and muxed with the video by a stream
+    copy. Clip readers are not thread-safe, so the frames have a single producer.
+    """
+
+    def __init__(self, clip, fps, ring_size=FRAME_RING_SIZE):
+        self.clip = clip
+        self.fps = fps
+        # Frame n shows the clip at n / fps, like moviepy writes it.
+        self.total = int(clip.duration * fps)
+        width, height = clip.size
+        self._buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(max(ring_size, 2))]
+        self._views = [memoryview(buffer).cast("B") for buffer in self._buffers]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._stop = threading.Event()
+
+    def write(self, path, codec="libx264", preset="medium", bitrate=None, threads=None, ffmpeg_params=None,
+              audio_codec="aac", audio_bitrate=None, faststart=False, logger=None, audio_logger=None):
+        """
+        Write the clip to ``path``. ``faststart`` moves the index of an MP4 output to its head. ``logger`` is the
+        proglog logger of the frames and ``audio_logger`` the one of the audio track, written on its own thread,
+        e.g. one aborting the write once the job is cancelled.
+        """
+        progress_logger = proglog.default_bar_logger(logger)
+        root, ext = os.path.splitext(path)
+        mux_params = ["-movflags", "+faststart"] if faststart else []
+        if self.clip.audio is None:
+            self._write_video(path, progress_logger, codec=codec, preset=preset, bitrate=bitrate, threads=threads,
+                              ffmpeg_params=list(ffmpeg_params or []) + mux_params)
+            return path
+
+        video_path = root + ".video" + ext
+        audio_path = root + ".audio." + find_extension(audio_codec)
+        audio_errors = []
+        audio_thread = threading.Thread(target=self._write_audio, name="audio-writer",
+                                        args=(audio_path, audio_codec, audio_bitrate, audio_logger, audio_errors))
+        audio_thread.start()
+        try:
+            try:
+                self._write_video(video_path, progress_logger, codec=codec, preset=preset, bitrate=bitrate,
+                                  threads=threads, ffmpeg_params=ffmpeg_params)
+            finally:
+                audio_thread.join()
+            if audio_errors:
+                raise audio_errors[0]
+            run_ffmpeg(["-i", video_path, "-i", audio_path, "-map", "0:v:0", "-map", "1:a:0", "-c", "copy",
+                        *mux_params, path])
+        finally:
+            for tmp_path in (video_path, audio_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return path
+
+    def _write_video(self, path, progress_logger, **params):
+        for slot in range(len(self._buffers)):
+            self._free.put(slot)
+        producer = threading.Thread(target=self._produce, name="frame-producer")
+        producer.start()
+        try:
+            with FFMPEG_VideoWriter(path, self.clip.size, self.fps, **params) as writer:
+                for _ in progress_logger.iter_bar(frame_index=range(self.total)):
+                    slot = self._filled.get()
+                    if isinstance(slot, BaseException):
+                        raise slot
+                    try:
+                        writer.proc.stdin.write(self._views[slot])
+                    except OSError:
+                        _, error = writer.proc.communicate()
+                        error = (error or b"").decode("utf-8", errors="replace").strip()
+                        raise RuntimeError(f"ffmpeg failed, path: {path}, error: {error}")
+                    self._free.put(slot)
+        finally:
+            self._stop.set()
+            # Unblock a producer waiting for a free buffer.
+            self._free.put(None)
+            producer.join()
+
+    def _produce(self):
+        try:
+            for index in range(self.total):
+                slot = self._free.get()
+                if slot is None or self._stop.is_set():
+                    return
+                frame = self.clip.get_frame(index / self.fps)
+                # Frames of float clips are truncated like moviepy's writer does.
+                np.copyto(self._buffers[slot], frame, casting="unsafe")
+                self._filled.put(slot)
+        except BaseException as e:
+            self._filled.put(e)
+
+    def _write_audio(self, audio_path, audio_codec, audio_bitrate, audio_logger, errors):
+        try:
+            self.clip.audio.write_audiofile(audio_path, fps=AUDIO_FPS, nbytes=AUDIO_NBYTES,
+                                            buffersize=AUDIO_BUFFERSIZE, codec=audio_codec, bitrate=audio_bitrate,
+                                            logger=audio_logger)
+        except JobCancelled as e:
+            errors.append(e)
+        except Exception as e:
+            logger.error("audio write failed, path: %s, error: %s", audio_path, e)
+            errors.append(e)
+
+
+def write_clip(clip, path, fps, **params) -> str:
+    """
+    Write ``clip`` with a FrameRingWriter, ``params`` as for FrameRingWriter.write.
+    """
+    return FrameRingWriter(clip, fps).write(path, **params)
@@ -1,6 +1,13 @@
+import math
+
 from PIL import Image
 from moviepy import ImageClip
 
+from config.common_config import IMG_QUALITY, IMG_PNG_COMPRESS_LEVEL
+
+# Downscale with Image.reduce first while the image is more than this factor above the target size.
+REDUCING_GAP = 3.0
+
 
 # Extend video file, first frame, mute
 def gen_video_with_img(img_path, extend_duration=1):
@@ -10,18 +17,40 @@ def gen_video_with_img(img_path, extend_duration=1):
 
 
 def img_resize(img_path, width, height):
-    origin_img = Image.open(img_path)
+    origin_img = open_img(img_path, [(width, height)])
+    return fit_img(origin_img, width, height), origin_img.format
+
+
+def open_img(img_path, sizes):
+    """
+    Open an image for resizing to each of ``sizes``. JPEGs are decoded at the smallest DCT scale that still covers
+    every target size, instead of at full resolution.
+    """
+    img = Image.open(img_path)
+    if img.format == 'JPEG':
+        original_width, original_height = img.size
+        # The size the image is scaled to before cropping, for the largest target.
+        scale = max(max(width / original_width, height / original_height) for width, height in sizes)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(original_width * scale), math.ceil(original_height * scale)))
+    return img
+
+
+def fit_img(origin_img, width, height):
+    """
+    Center-crop the image to the aspect ratio of ``width`` x ``height`` and resize it.
+    """
     original_width, original_height = origin_img.size
     # The dimensions are the same, no need to resize.
     if original_width == width and original_height == height:
-        return origin_img, origin_img.format
+        return origin_img
 
     if origin_img.mode in ('P', 'RGBA'):
         origin_img = origin_img.convert('RGB')
 
     # The aspect ratio is the same, resize directly.
     if original_width / original_height == (width / height):
-        return origin_img.resize((width, height), resample=Image.LANCZOS), origin_img.format
+        return origin_img.resize((width, height), resample=Image.LANCZOS, reducing_gap=REDUCING_GAP)
 
     # The aspect ratio is different, crop first, then resize.
     if (original_width / original_height) > (width / height):
@@ -39,5 +68,23 @@ def img_resize(img_path, width, height):
     top = y_center - new_height // 2
     right = x_center + new_width // 2
     bottom = y_center + new_height // 2
-    crop_img = origin_img.crop((left, top, right, bottom))
-    return crop_img.resize((width, height), resample=Image.LANCZOS), origin_img.format
+    # Resize straight from the box, the cropped copy is never made.
+    return origin_img.resize((width, height), resample=Image.LANCZOS, box=(left, top, right, bottom),
+                             reducing_gap=REDUCING_GAP)
+
+
+def save_img(img, path, format, quality=None):
+    """
+    Save the image with the encoder settings of ``format``, ``quality`` applies to JPEG and WEBP.
+    """
+    format = format.upper()
+    if format == 'JPEG':
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.save(path, format, quality=quality or IMG_QUALITY['JPEG'])
+    elif format == 'WEBP':
+        img.save(path, format, quality=quality or IMG_QUALITY['WEBP'], method=4)
+    elif format == 'PNG':
+        img.save(path, format, compress_level=IMG_PNG_COMPRESS_LEVEL)
+    else:
+        img.save(path, format)
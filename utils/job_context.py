@@ -0,0 +1,96 @@
+import time
+
+from proglog import ProgressBarLogger
+
+# Minimum seconds between two progress events of a stage, and between two cancellation checks.
+REPORT_INTERVAL = 0.5
+CANCEL_CHECK_INTERVAL = 0.25
+
+
+class JobCancelled(Exception):
+    def __init__(self, task_id=None):
+        super().__init__(f"job cancelled, task_id: {task_id}")
+        self.task_id = task_id
+
+    def __reduce__(self):
+        return JobCancelled, (self.task_id,)
+
+
+class JobContext:
+    """
+    Progress reporting and cancellation of a running job.
+
+    The context is picklable, its event queue and cancel flag are multiprocessing manager proxies, so it can be
+    passed on to worker processes and threads. A context without them reports nothing and is never cancelled.
+    ``cores`` is the number of cores the job may keep busy, None for all of them.
+    """
+
+    def __init__(self, task_id, job_id=None, events=None, cancel_event=None, cores=None):
+        self.task_id = task_id
+        self.job_id = job_id
+        self.cores = cores
+        self._events = events
+        self._cancel_event = cancel_event
+        self._last_report = {}
+        self._last_cancel_check = 0
+        self._cancelled = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_last_report"] = {}
+        return state
+
+    def report(self, stage, current, total, **data):
+        if self._events is None:
+            return
+        now = time.monotonic()
+        if current < total and now - self._last_report.get(stage, 0) < REPORT_INTERVAL:
+            return
+        self._last_report[stage] = now
+        self._events.put({"job_id": self.job_id, "task_id": self.task_id, "stage": stage, "current": current,
+                          "total": total, **data})
+
+    def cancel(self):
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+
+    def is_cancelled(self):
+        if self._cancelled or self._cancel_event is None:
+            return self._cancelled
+        now = time.monotonic()
+        if now - self._last_cancel_check >= CANCEL_CHECK_INTERVAL:
+            self._last_cancel_check = now
+            self._cancelled = self._cancel_event.is_set()
+        return self._cancelled
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise JobCancelled(self.task_id)
+
+    def progress_logger(self, stage):
+        return JobProgressLogger(self, stage)
+
+
+class JobProgressLogger(ProgressBarLogger):
+    """
+    moviepy logger that reports the encoded frames with an ETA, and aborts the encode once the job is cancelled.
+    Without a stage it only checks for cancellation.
+    """
+
+    def __init__(self, context, stage):
+        super().__init__()
+        self.context = context
+        self.stage = stage
+        self._started = None
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        self.context.check_cancelled()
+        if self.stage is None or bar != "frame_index" or attr != "index":
+            return
+        if self._started is None:
+            self._started = time.monotonic()
+        total = self.bars[bar]["total"]
+        current = value + 1
+        elapsed = time.monotonic() - self._started
+        eta = elapsed / current * (total - current) if current else None
+        self.context.report(self.stage, current, total, eta=round(eta, 1) if eta is not None else None)
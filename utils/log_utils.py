@@ -0,0 +1,93 @@
+import copy
+import json
+import logging
+import random
+from logging.handlers import QueueHandler
+
+from config.common_config import LOG_PAYLOAD_MAX_CHARS, LOG_PAYLOAD_SAMPLE_RATE
+
+
+class Payload:
+    """
+    Log argument for request payloads. The payload is serialized only when the record is formatted, by the log
+    listener thread, cut to ``max_chars``, and left out of the log unless sampled.
+    """
+
+    def __init__(self, value, sample=True, max_chars=LOG_PAYLOAD_MAX_CHARS):
+        self.value = value
+        self.sampled = not sample or random.random() < LOG_PAYLOAD_SAMPLE_RATE
+        self.max_chars = max_chars
+
+    def __str__(self):
+        if not self.sampled:
+            return f"<{type(self.value).__name__} not sampled>"
+        text = self._serialize()
+        if len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}...<{len(text) - self.max_chars} more chars>"
+        return text
+
+    def _serialize(self):
+        if isinstance(self.value, (str, bytes)):
+            return self.value if isinstance(self.value, str) else self.value.decode("utf-8", errors="replace")
+        if hasattr(self.value, "model_dump_json"):
+            return self.value.model_dump_json()
+        try:
+            return json.dumps(self.value, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            return str(self.value)
+
+
+def payload(value, sample=True) -> Payload:
+    return Payload(value, sample)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line.
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # Formatted by the worker process that logged it.
+            data["exception"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts records on the queue unformatted, unlike QueueHandler, which formats them in the logging thread and drops
+    their exc_info. The message, its arguments and the traceback are formatted by the handlers of the listener.
+    Records only travel within the process, so their arguments need not be pickled.
+    """
+
+    def prepare(self, record):
+        # A copy, the other handlers of the logger get the record as it was.
+        return copy.copy(record)
+
+
+class ProcessQueueHandler(QueueHandler):
+    """
+    Puts records on a queue to another process. The message and the traceback are formatted here, their objects may
+    not be picklable, the handlers of the other process format the rest.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exception_formatter = logging.Formatter()
@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Optional
+
+from pydantic import BaseModel
+
+from config.common_config import MATERIAL_CACHE_DIR, MATERIAL_CACHE_MAX_BYTES, MATERIAL_CACHE_FRESH_SECONDS
+from utils import metrics
+from utils.storage import file_lock, scan_lru, evict_lru, lazy_instance
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(BaseModel):
+    url: str
+    file_name: str
+    sha256: str
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    validated_at: float = 0
+
+
+class MaterialCache:
+    """
+    On-disk material cache shared by all worker processes. Blobs are stored once per content hash and hard-linked
+    into the tasks, urls map to blobs through metadata files holding their ETag and Last-Modified validators.
+    """
+
+    def __init__(self, root=MATERIAL_CACHE_DIR, max_bytes=MATERIAL_CACHE_MAX_BYTES,
+                 fresh_seconds=MATERIAL_CACHE_FRESH_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self._stats = {"hit": 0, "revalidated": 0, "miss": 0, "eviction": 0, "bytes_downloaded": 0,
+                       "bytes_served": 0}
+        self._stats_lock = threading.Lock()
+        for sub_dir in ("blobs", "urls", "locks", "tmp"):
+            os.makedirs(os.path.join(root, sub_dir), exist_ok=True)
+
+    def lock(self, url):
+        # Concurrent downloads of the same url are serialized.
+        return file_lock(os.path.join(self.root, "locks", self._url_key(url) + ".lock"))
+
+    def lookup(self, url) -> Optional[CacheEntry]:
+        try:
+            with open(self._meta_path(url), encoding="utf-8") as f:
+                entry = CacheEntry.model_validate_json(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(self._blob_path(entry.sha256)):
+            return None
+        return entry
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.validated_at < self.fresh_seconds
+
+    def new_temp_path(self):
+        return os.path.join(self.root, "tmp", uuid.uuid4().hex)
+
+    def store(self, url, tmp_path, file_name, sha256, etag=None, last_modified=None) -> CacheEntry:
+        """
+        Move a downloaded file into the cache and record it for the url.
+        """
+        blob_path = self._blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        size = os.path.getsize(tmp_path)
+        if os.path.exists(blob_path):
+            # Same content is already cached under another url.
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, blob_path)
+        entry = CacheEntry(url=url, file_name=file_name, sha256=sha256, size=size, etag=etag,
+                           last_modified=last_modified, validated_at=time.time())
+        self._write_meta(entry)
+        self._count("miss", bytes_downloaded=size)
+        # Never evict the new blob before the task had a chance to link it.
+        self.evict(keep=blob_path)
+        return entry
+
+    def revalidated(self, entry: CacheEntry) -> CacheEntry:
+        entry = entry.model_copy(update={"validated_at": time.time()})
+        self._write_meta(entry)
+        self._count("revalidated")
+        return entry
+
+    def hit(self):
+        self._count("hit")
+
+    def contains(self, entry: CacheEntry, file_path) -> bool:
+        """
+        Whether ``file_path`` is a link to the blob of the entry.
+        """
+        try:
+            return os.path.samefile(self._blob_path(entry.sha256), file_path)
+        except FileNotFoundError:
+            return False
+
+    def link(self, entry: CacheEntry, path) -> str:
+        """
+        Hard-link the cached blob into ``path`` and return the file path. Raises FileNotFoundError if the blob has
+        been evicted in the meantime.
+        """
+        blob_path = self._blob_path(entry.sha256)
+        os.makedirs(path, exist_ok=True)
+        # Fall back to a hash-prefixed name if another material of the task has the same file name.
+        for file_name in (entry.file_name, entry.sha256[:12] + "_" + entry.file_name):
+            file_path = os.path.join(path, file_name)
+            try:
+                os.link(blob_path, file_path)
+                break
+            except FileExistsError:
+                if os.path.samefile(file_path, blob_path):
+                    break
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # Cache and task directory are on different devices.
+                shutil.copyfile(blob_path, file_path)
+                break
+        # Bump the blob in the LRU order.
+        os.utime(blob_path)
+        with self._stats_lock:
+            self._stats["bytes_served"] += entry.size
+        return file_path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used blobs, except ``keep``, until the cache fits into ``max_bytes``.
+        """
+        with file_lock(os.path.join(self.root, "locks", "evict.lock")):
+            blobs = []
+            for shard in os.scandir(os.path.join(self.root, "blobs")):
+                blobs.extend(scan_lru(shard.path))
+            evict_lru(blobs, self.max_bytes, self._remove_blob, keep)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hit"] + stats["revalidated"] + stats["miss"]
+        stats["hit_ratio"] = (stats["hit"] + stats["revalidated"]) / lookups if lookups else 0
+        return stats
+
+    def _remove_blob(self, blob_path, size):
+        try:
+            os.remove(blob_path)
+        except FileNotFoundError:
+            return False
+        self._count("eviction")
+        logger.info("material cache evict, blob: %s, size: %s", blob_path, size)
+        return True
+
+    def _count(self, name, bytes_downloaded=0):
+        with self._stats_lock:
+            self._stats[name] += 1
+            self._stats["bytes_downloaded"] += bytes_downloaded
+        if name == "eviction":
+            metrics.inc("material_cache_evictions_total")
+        else:
+            metrics.inc("material_cache_lookups_total", result=name)
+        if bytes_downloaded:
+            metrics.inc("material_cache_downloaded_bytes_total", bytes_downloaded)
+
+    def _write_meta(self, entry: CacheEntry):
+        meta_path = self._meta_path(entry.url)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        tmp_path = self.new_temp_path()
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(entry.model_dump_json())
+        os.replace(tmp_path, meta_path)
+
+    def _meta_path(self, url):
+        key = self._url_key(url)
+        return os.path.join(self.root, "urls", key[:2], key + ".json")
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    @staticmethod
+    def _url_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+_material_cache = lazy_instance(MaterialCache)
+
+
+def get_material_cache() -> MaterialCache:
+    return _material_cache()
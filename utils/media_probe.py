@@ -0,0 +1,43 @@
+import os
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from PIL import Image
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from pydantic import BaseModel
+
+
+class MediaInfo(BaseModel):
+    # Container duration (what AudioFileClip reports) and video stream duration (what VideoFileClip reports).
+    duration: float = 0
+    video_duration: float = 0
+    size: Optional[Tuple[int, int]] = None
+    fps: Optional[float] = None
+    audio_fps: Optional[int] = None
+    has_video: bool = False
+    has_audio: bool = False
+
+
+# Probe a media file once per process, the result is cached until the file changes.
+def probe(path) -> MediaInfo:
+    stat = os.stat(path)
+    return _probe(path, stat.st_mtime_ns, stat.st_size)
+
+
+def probe_image(path) -> MediaInfo:
+    with Image.open(path) as img:
+        return MediaInfo(size=img.size, has_video=True)
+
+
+@lru_cache(maxsize=1024)
+def _probe(path, mtime_ns, size) -> MediaInfo:
+    infos = ffmpeg_parse_infos(path)
+    return MediaInfo(
+        duration=infos.get("duration", 0),
+        video_duration=infos.get("video_duration", 0),
+        size=tuple(infos["video_size"]) if infos.get("video_found") else None,
+        fps=infos.get("video_fps"),
+        audio_fps=infos.get("audio_fps"),
+        has_video=infos.get("video_found", False),
+        has_audio=infos.get("audio_found", False),
+    )
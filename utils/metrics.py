@@ -0,0 +1,296 @@
+import functools
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config.common_config import METRICS_DIR, METRICS_FLUSH_INTERVAL
+from utils import storage
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "omni_editor_"
+# Upper bounds of the duration histogram buckets in seconds.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf)
+# Suffix of the file of a host holding the samples of its exited processes.
+AGGREGATE_SUFFIX = ".aggregate.json"
+
+
+class Registry:
+    """
+    Counters and histograms of one process, written to a file of its own in METRICS_DIR at most every
+    METRICS_FLUSH_INTERVAL seconds. ``collect`` merges the files of all processes.
+    """
+
+    def __init__(self, metrics_dir=METRICS_DIR):
+        self.metrics_dir = metrics_dir
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self._path = os.path.join(metrics_dir, f"{self.host}-{self.pid}-{uuid.uuid4().hex[:8]}.json")
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.setdefault(key, {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0, "count": 0})
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+        self._maybe_flush()
+
+    def flush(self):
+        with self._lock:
+            data = json.dumps({"counters": self._counters, "histograms": self._histograms})
+            self._last_flush = time.monotonic()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path)
+
+    def collect(self) -> dict:
+        """
+        The samples of all processes, summed.
+        """
+        self.flush()
+        self.prune()
+        merged = {"counters": {}, "histograms": {}}
+        for entry in os.scandir(self.metrics_dir):
+            if entry.name.endswith(".json"):
+                _merge(merged, _load(entry.path))
+        return merged
+
+    def prune(self):
+        """
+        Merge the files of the exited processes of this host into the aggregate file of the host and remove them,
+        their samples are final. Processes of other hosts are pruned there.
+        """
+        with storage.file_lock(os.path.join(self.metrics_dir, "prune.lock")):
+            exited = []
+            for entry in os.scandir(self.metrics_dir):
+                if not entry.name.endswith(".json") or entry.name.endswith(AGGREGATE_SUFFIX):
+                    continue
+                try:
+                    host, pid, _ = entry.name[:-len(".json")].rsplit("-", 2)
+                    pid = int(pid)
+                except ValueError:
+                    continue
+                if host == self.host and pid != self.pid and not _is_running(pid):
+                    exited.append(entry.path)
+            if not exited:
+                return
+            aggregate_path = os.path.join(self.metrics_dir, self.host + AGGREGATE_SUFFIX)
+            aggregate = {"counters": {}, "histograms": {}}
+            _merge(aggregate, _load(aggregate_path))
+            for path in exited:
+                _merge(aggregate, _load(path))
+            tmp_path = aggregate_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(aggregate, f)
+            os.replace(tmp_path, aggregate_path)
+            for path in exited:
+                os.remove(path)
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            logger.error("metrics flush failed, error: %s", e)
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.bytes = 0
+        self.frames = 0
+
+    def add(self, bytes=0, frames=0):
+        self.bytes += bytes
+        self.frames += frames
+
+
+@contextmanager
+def span(stage):
+    """
+    Time a pipeline stage. The yielded Span takes the bytes and frames the stage processed.
+    """
+    s = Span(stage)
+    started = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        get_registry().inc(PREFIX + "stage_errors_total", stage=stage)
+        raise
+    finally:
+        registry = get_registry()
+        registry.observe(PREFIX + "stage_duration_seconds", time.perf_counter() - started, stage=stage)
+        if s.bytes:
+            registry.inc(PREFIX + "stage_bytes_total", s.bytes, stage=stage)
+        if s.frames:
+            registry.inc(PREFIX + "stage_frames_total", s.frames, stage=stage)
+
+
+def timed(stage):
+    """
+    Decorator timing every call of the function as a span of ``stage``.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def prune():
+    try:
+        get_registry().prune()
+    except OSError as e:
+        logger.error("metrics prune failed, error: %s", e)
+
+
+def inc(name, value=1, **labels):
+    get_registry().inc(PREFIX + name, value, **labels)
+
+
+def flush():
+    try:
+        get_registry().flush()
+    except OSError as e:
+        logger.error("metrics flush failed, error: %s", e)
+
+
+# Gauges computed when the metrics are scraped: name -> (help, callback returning {labels tuple: value}).
+_gauges = {}
+
+
+def register_gauge(name, help, callback):
+    _gauges[PREFIX + name] = (help, callback)
+
+
+def render() -> str:
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    merged = get_registry().collect()
+    lines = []
+    for name, series in sorted(merged["counters"].items()):
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{_format_labels(key)} {value}")
+    for name, series in sorted(merged["histograms"].items()):
+        lines.append(f"# TYPE {name} histogram")
+        for key, histogram in sorted(series.items()):
+            for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(key, le=le)} {count}")
+            lines.append(f"{name}_sum{_format_labels(key)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(key)} {histogram['count']}")
+    for name, (help, callback) in sorted(_gauges.items()):
+        try:
+            samples = callback()
+        except Exception as e:
+            logger.error("metrics gauge failed, name: %s, error: %s", name, e, exc_info=True)
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples.items():
+            lines.append(f"{name}{_format_labels(_labels_key(dict(labels)))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset(metrics_dir=METRICS_DIR):
+    """
+    Remove the samples of earlier server runs, call once at startup.
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    for entry in os.scandir(metrics_dir):
+        if entry.is_file():
+            os.remove(entry.path)
+
+
+def _load(path) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"counters": {}, "histograms": {}}
+
+
+def _merge(merged, data):
+    for name, series in data["counters"].items():
+        merged_series = merged["counters"].setdefault(name, {})
+        for key, value in series.items():
+            merged_series[key] = merged_series.get(key, 0) + value
+    for name, series in data["histograms"].items():
+        merged_series = merged["histograms"].setdefault(name, {})
+        for key, histogram in series.items():
+            merged_histogram = merged_series.setdefault(
+                key, {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0, "count": 0})
+            merged_histogram["buckets"] = [a + b for a, b in zip(merged_histogram["buckets"], histogram["buckets"])]
+            merged_histogram["sum"] += histogram["sum"]
+            merged_histogram["count"] += histogram["count"]
+
+
+def _is_running(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, as another user.
+        pass
+    return True
+
+
+def _labels_key(labels) -> str:
+    return ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+
+
+def _format_labels(key, **extra):
+    labels = [item.split("=", 1) for item in key.split(",") if item] + list(extra.items())
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> Registry:
+    global _registry
+    # A process started with fork must not write to the file of its parent.
+    if _registry is None or _registry.pid != os.getpid():
+        with _registry_lock:
+            if _registry is None or _registry.pid != os.getpid():
+                _registry = Registry()
+    return _registry
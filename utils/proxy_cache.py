@@ -0,0 +1,133 @@
+import logging
+import os
+import shutil
+import uuid
+
+from PIL import Image
+
+from config.common_config import PROXY_CACHE_DIR, PROXY_CACHE_MAX_BYTES
+from utils import metrics
+from utils.ffmpeg_utils import run_ffmpeg
+from utils.img_utils import open_img, fit_img
+from utils.storage import file_lock, scan_lru, evict_lru, lazy_instance
+
+logger = logging.getLogger(__name__)
+
+# x264 settings of video proxies: fast, and near-lossless as the render encodes them once more.
+PROXY_VIDEO_CRF = 8
+PROXY_VIDEO_ARGS = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", str(PROXY_VIDEO_CRF), "-pix_fmt", "yuv420p"]
+
+
+class ProxyCache:
+    """
+    Materials center-cropped and scaled to an output size, and resampled to a frame rate if one is given, keyed by
+    their content hash. Shared by all worker processes and hard-linked into the tasks.
+    """
+
+    def __init__(self, root=PROXY_CACHE_DIR, max_bytes=PROXY_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        for sub_dir in ("proxies", "locks", "tmp"):
+            os.makedirs(os.path.join(root, sub_dir), exist_ok=True)
+
+    def get_video(self, sha256, source_path, size, path, fps=None) -> str:
+        """
+        Link the video proxy into the directory ``path`` and return the file path.
+        """
+        key = f"{sha256}_{size[0]}x{size[1]}" + (f"_{fps}fps" if fps else "") + f"_q{PROXY_VIDEO_CRF}"
+        return self._get(key, ".mkv", lambda tmp_path: self._write_video(source_path, tmp_path, size, fps), path)
+
+    def get_image(self, sha256, source_path, size, path) -> str:
+        """
+        Link the image proxy into the directory ``path`` and return the file path.
+        """
+        with Image.open(source_path) as img:
+            # Keep the alpha channel of images that have one.
+            ext = ".png" if img.mode in ("RGBA", "LA", "P") else ".jpg"
+        return self._get(f"{sha256}_{size[0]}x{size[1]}", ext,
+                         lambda tmp_path: self._write_image(source_path, tmp_path, size), path)
+
+    def evict(self, keep=None):
+        with file_lock(os.path.join(self.root, "locks", "evict.lock")):
+            evict_lru(scan_lru(os.path.join(self.root, "proxies")), self.max_bytes, self._remove_proxy, keep)
+
+    def _get(self, key, ext, write, path):
+        try:
+            return self._link(self._get_proxy(key, ext, write), path)
+        except FileNotFoundError:
+            # The proxy has been evicted since it was found or made.
+            return self._link(self._get_proxy(key, ext, write), path)
+
+    def _get_proxy(self, key, ext, write):
+        proxy_path = os.path.join(self.root, "proxies", key + ext)
+        # Only one worker scales a material at a time, the others wait and reuse its proxy.
+        with file_lock(os.path.join(self.root, "locks", key + ".lock")):
+            try:
+                # Bump the proxy in the LRU order.
+                os.utime(proxy_path)
+                metrics.inc("proxy_cache_lookups_total", result="hit")
+                return proxy_path
+            except FileNotFoundError:
+                pass
+            tmp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex + ext)
+            try:
+                with metrics.span("proxy"):
+                    write(tmp_path)
+                os.replace(tmp_path, proxy_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        metrics.inc("proxy_cache_lookups_total", result="miss")
+        self.evict(keep=proxy_path)
+        return proxy_path
+
+    @staticmethod
+    def _remove_proxy(proxy_path, size):
+        try:
+            os.remove(proxy_path)
+        except FileNotFoundError:
+            return False
+        logger.info("proxy cache evict: %s, size: %s", proxy_path, size)
+        return True
+
+    @staticmethod
+    def _link(proxy_path, path):
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, os.path.basename(proxy_path))
+        try:
+            os.link(proxy_path, file_path)
+        except FileExistsError:
+            # Linked for another shot of the task.
+            pass
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # Cache and task directory are on different devices.
+            shutil.copyfile(proxy_path, file_path)
+        return file_path
+
+    @staticmethod
+    def _write_video(source_path, tmp_path, size, fps=None):
+        width, height = size
+        filters = [f"scale={width}:{height}:force_original_aspect_ratio=increase", f"crop={width}:{height}", "setsar=1"]
+        if fps:
+            # Frames are dropped before scaling, frame n is the last frame at or before n / fps, as moviepy reads it.
+            filters.insert(0, f"fps={fps}:round=up")
+        run_ffmpeg(["-i", source_path, "-map", "0:v:0", "-map", "0:a:0?", "-vf", ",".join(filters),
+                    *PROXY_VIDEO_ARGS, "-c:a", "copy", "-f", "matroska", tmp_path])
+
+    @staticmethod
+    def _write_image(source_path, tmp_path, size):
+        with open_img(source_path, [size]) as img:
+            proxy = fit_img(img, *size)
+            if tmp_path.endswith(".png"):
+                proxy.save(tmp_path, format="PNG", compress_level=1)
+            else:
+                proxy.convert("RGB").save(tmp_path, format="JPEG", quality=90)
+
+
+_proxy_cache = lazy_instance(ProxyCache)
+
+
+def get_proxy_cache() -> ProxyCache:
+    return _proxy_cache()
@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+from config.common_config import FILE_DIR, RENDER_CACHE_DIR, RENDER_CACHE_MAX_SEGMENT_BYTES
+from utils import metrics
+from utils.storage import find_output, output_path, output_tmp_path, file_lock, scan_lru, evict_lru, lazy_instance
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache:
+    """
+    Render results shared by all worker processes: outputs stay in FILE_DIR named after their render key and
+    hard-linked to the task names, shot segments are kept in the cache up to ``max_segment_bytes``.
+    """
+
+    def __init__(self, root=RENDER_CACHE_DIR, max_segment_bytes=RENDER_CACHE_MAX_SEGMENT_BYTES, output_dir=FILE_DIR):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self.output_dir = output_dir
+        self._stats = {"output_hit": 0, "output_miss": 0, "segment_hit": 0, "segment_miss": 0}
+        self._stats_lock = threading.Lock()
+        for sub_dir in ("segments", "locks", "tmp"):
+            os.makedirs(os.path.join(root, sub_dir), exist_ok=True)
+
+    def get_output(self, key, video_name) -> Optional[str]:
+        """
+        Link the finished output of the render key to ``video_name`` and return the name, if the output still exists.
+        """
+        found = self.link_output(key, video_name)
+        self._count("output_hit" if found else "output_miss")
+        return video_name if found else None
+
+    def link_output(self, key, video_name) -> bool:
+        """
+        Link the output of the render key, rendered to ``output_name(key)``, to ``video_name`` in FILE_DIR, replacing
+        an earlier render of that name. Returns whether the output exists.
+        """
+        name, ext = os.path.splitext(video_name)
+        source_name = self.output_name(key, ext)
+        directory = find_output(source_name, self.output_dir)
+        if directory is None:
+            return False
+        source_path = os.path.join(directory, source_name)
+        tmp_path = output_tmp_path(video_name, self.output_dir)
+        try:
+            os.link(source_path, tmp_path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.replace(tmp_path, output_path(video_name, self.output_dir))
+        finally:
+            # A rename onto another link of the same file does nothing.
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        try:
+            # The storage janitor expires outputs by their last use, the access time. The mtime stays, it is part of
+            # the ETag of the output.
+            os.utime(source_path, ns=(time.time_ns(), os.stat(source_path).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        return True
+
+    @staticmethod
+    def output_name(key, ext=".mp4") -> str:
+        return key + ext
+
+    def get_segment(self, key) -> Optional[str]:
+        segment_path = self._segment_path(key)
+        try:
+            # Bump the segment in the LRU order.
+            os.utime(segment_path)
+        except FileNotFoundError:
+            self._count("segment_miss")
+            return None
+        self._count("segment_hit")
+        return segment_path
+
+    def put_segment(self, key, tmp_path) -> str:
+        segment_path = self._segment_path(key)
+        os.replace(tmp_path, segment_path)
+        self.evict_segments(keep=segment_path)
+        return segment_path
+
+    def new_temp_path(self, ext):
+        return os.path.join(self.root, "tmp", uuid.uuid4().hex + ext)
+
+    def evict_segments(self, keep=None):
+        with file_lock(os.path.join(self.root, "locks", "evict.lock")):
+            evict_lru(scan_lru(os.path.join(self.root, "segments")), self.max_segment_bytes, self._remove_segment,
+                      keep)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+        kind, result = name.split("_")
+        metrics.inc("render_cache_lookups_total", kind=kind, result=result)
+
+    @staticmethod
+    def _remove_segment(segment_path, size):
+        try:
+            os.remove(segment_path)
+        except FileNotFoundError:
+            return False
+        logger.info("render cache evict segment: %s, size: %s", segment_path, size)
+        return True
+
+    def _segment_path(self, key):
+        return os.path.join(self.root, "segments", key + ".mov")
+
+
+_render_cache = lazy_instance(RenderCache)
+
+
+def get_render_cache() -> RenderCache:
+    return _render_cache()
@@ -0,0 +1,252 @@
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config.common_config import FILE_DIR, TASK_MATERIAL_DIR, SEGMENT_DIR, MATERIAL_CACHE_DIR, RENDER_CACHE_DIR, \
+    PROXY_CACHE_DIR, OUTPUT_SHARD_DEPTH, OUTPUT_TTL, OUTPUT_MAX_BYTES, SCRATCH_TTL, STORAGE_JANITOR_INTERVAL
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Infix of the files an output is written to before it is complete.
+TMP_INFIX = ".tmp."
+
+
+def output_dir(file_name, root=FILE_DIR) -> str:
+    """
+    The shard directory of an output. Names are spread by their hash, so no directory holds more than a small part
+    of the outputs and the download route finds a file from its name alone.
+    """
+    digest = hashlib.sha256(file_name.encode("utf-8")).hexdigest()
+    return os.path.join(root, *(digest[i * 2:i * 2 + 2] for i in range(OUTPUT_SHARD_DEPTH)))
+
+
+def output_path(file_name, root=FILE_DIR) -> str:
+    """
+    The path of an output, its shard directory is created.
+    """
+    shard_dir = output_dir(file_name, root)
+    os.makedirs(shard_dir, exist_ok=True)
+    return os.path.join(shard_dir, file_name)
+
+
+def output_tmp_path(file_name, root=FILE_DIR) -> str:
+    """
+    A new temporary path an output is written to, in its shard so it can be renamed into place.
+    """
+    name, ext = os.path.splitext(file_name)
+    return output_path(name + TMP_INFIX + uuid.uuid4().hex[:8] + ext, root)
+
+
+def find_output(file_name, root=FILE_DIR):
+    """
+    The directory holding an output, outputs written before sharding are still found at the top level.
+    """
+    for directory in (output_dir(file_name, root), root):
+        if os.path.isfile(os.path.join(directory, file_name)):
+            return directory
+    return None
+
+
+def new_scratch_name(task_id) -> str:
+    """
+    A name of its own for the scratch directories of a job, so concurrent jobs of the same task, e.g. its preview
+    and its final render, never share or remove each other's files.
+    """
+    return f"{task_id}_{uuid.uuid4().hex[:8]}"
+
+
+def remove_task_materials(scratch_name):
+    """
+    Remove the scratch directory the materials of a job were linked into. The materials stay in the cache.
+    """
+    shutil.rmtree(TASK_MATERIAL_DIR.format(task_id=scratch_name), ignore_errors=True)
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Hold an exclusive lock on ``lock_path``, shared by all worker processes.
+    """
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def scan_lru(directory) -> list:
+    """
+    The (mtime, size, path) of the files in ``directory``, the input of ``evict_lru``.
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def evict_lru(entries, max_bytes, remove, keep=None):
+    """
+    Remove the least recently used of ``entries``, (last use, size, item) tuples, except ``keep``, until they fit into
+    ``max_bytes``. ``remove(item, size)`` returns whether it freed the item.
+    """
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    for _, size, item in sorted(entries, key=lambda entry: entry[0]):
+        if total <= max_bytes:
+            break
+        if item == keep:
+            continue
+        if remove(item, size):
+            total -= size
+
+
+def lazy_instance(factory):
+    """
+    A getter creating ``factory()`` on its first call and returning the same instance afterwards.
+    """
+    instance = None
+    lock = threading.Lock()
+
+    def get():
+        nonlocal instance
+        if instance is None:
+            with lock:
+                if instance is None:
+                    instance = factory()
+        return instance
+
+    return get
+
+
+class StorageJanitor:
+    """
+    Background sweeper expiring outputs after ``output_ttl`` from their last use and bounding them to
+    ``output_max_bytes``, and removing the scratch files crashed renders left behind for longer than ``scratch_ttl``.
+    """
+
+    def __init__(self, root=FILE_DIR, output_ttl=OUTPUT_TTL, output_max_bytes=OUTPUT_MAX_BYTES,
+                 scratch_ttl=SCRATCH_TTL, interval=STORAGE_JANITOR_INTERVAL):
+        self.root = root
+        self.output_ttl = output_ttl
+        self.output_max_bytes = output_max_bytes
+        self.scratch_ttl = scratch_ttl
+        self.interval = interval
+        self.scratch_dirs = [os.path.dirname(os.path.normpath(TASK_MATERIAL_DIR)),
+                             os.path.dirname(os.path.normpath(SEGMENT_DIR)),
+                             os.path.join(MATERIAL_CACHE_DIR, "tmp"),
+                             os.path.join(RENDER_CACHE_DIR, "tmp"),
+                             os.path.join(PROXY_CACHE_DIR, "tmp")]
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="storage-janitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sweep(self):
+        now = time.time()
+        with metrics.span("storage_sweep"):
+            self.sweep_outputs(now)
+            for scratch_dir in self.scratch_dirs:
+                self.sweep_scratch(scratch_dir, now)
+        metrics.flush()
+
+    def sweep_outputs(self, now):
+        # (device, inode) -> (last use, size, paths), an output and the task names linked to it, which count once.
+        outputs = {}
+        for path, stat in self._scan_outputs():
+            if TMP_INFIX in os.path.basename(path):
+                if now - stat.st_mtime > self.scratch_ttl:
+                    self._remove(path, stat.st_size, "scratch")
+                continue
+            last_used = max(stat.st_atime, stat.st_mtime)
+            if now - last_used > self.output_ttl:
+                self._remove(path, stat.st_size, "output_ttl")
+                continue
+            outputs.setdefault((stat.st_dev, stat.st_ino), (last_used, stat.st_size, []))[2].append(path)
+        evict_lru(list(outputs.values()), self.output_max_bytes, self._remove_output)
+
+    def sweep_scratch(self, scratch_dir, now):
+        try:
+            entries = list(os.scandir(scratch_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime <= self.scratch_ttl:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                metrics.inc("storage_evictions_total", kind="scratch")
+                logger.info("storage janitor remove scratch dir: %s", entry.path)
+            else:
+                self._remove(entry.path, stat.st_size, "scratch")
+
+    def _scan_outputs(self):
+        # Shard directories, and the top level for outputs written before sharding. Other directories of FILE_DIR,
+        # like the data tree, are not outputs.
+        pending = [(self.root, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth < OUTPUT_SHARD_DEPTH and _is_shard_name(entry.name):
+                            pending.append((entry.path, depth + 1))
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path, entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+
+    def _remove_output(self, paths, size):
+        for i, path in enumerate(paths):
+            # The space is freed once, with the last name.
+            self._remove(path, size if i == len(paths) - 1 else 0, "output_quota")
+        return True
+
+    def _remove(self, path, size, kind):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        metrics.inc("storage_evictions_total", kind=kind)
+        metrics.inc("storage_evicted_bytes_total", size, kind=kind)
+        logger.info("storage janitor remove: %s, size: %s, reason: %s", path, size, kind)
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("storage janitor sweep failed, error: %s", e, exc_info=True)
+            if self._stop.wait(self.interval):
+                return
+
+
+def _is_shard_name(name):
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
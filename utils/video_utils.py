@@ -1,3 +1,5 @@
+from bisect import bisect_right
+
 from moviepy import ImageClip, concatenate_videoclips
 
 
@@ -7,4 +9,62 @@ def extend_video_with_first_frame(video_clip, extend_duration=1):
     first_frame_clip = ImageClip(first_frame).with_duration(extend_duration)
     first_frame_clip = first_frame_clip.without_audio()
     clips = [first_frame_clip, video_clip]
-    return concatenate_videoclips(clips, method="compose")
+    # The first frame always has the size of the video, the compose method would composite every frame.
+    method = "chain" if first_frame_clip.size == video_clip.size else "compose"
+    return concatenate_videoclips(clips, method=method)
+
+
+class StillRuns:
+    """
+    Time ranges of a clip that show a single still picture, e.g. an image shot or an extended first frame.
+
+    A range is split into runs at the ``boundaries`` where its captions change, all frames of a run are identical.
+    """
+
+    def __init__(self, ranges=(), boundaries=()):
+        self.ranges = sorted((start, end) for start, end in ranges if end > start)
+        self.boundaries = sorted(set(boundaries))
+        self._starts = [start for start, _ in self.ranges]
+
+    def key(self, t):
+        """
+        The run at ``t``, None if the frame at ``t`` is not a still.
+        """
+        i = bisect_right(self._starts, t) - 1
+        if i < 0 or t >= self.ranges[i][1]:
+            return None
+        return i, bisect_right(self.boundaries, t)
+
+    @staticmethod
+    def concatenate(runs, durations):
+        """
+        The runs of clips played one after the other.
+        """
+        ranges = []
+        boundaries = []
+        start = 0
+        for clip_runs, duration in zip(runs, durations):
+            ranges.extend((range_start + start, range_end + start) for range_start, range_end in clip_runs.ranges)
+            boundaries.extend(boundary + start for boundary in clip_runs.boundaries)
+            start += duration
+        return StillRuns(ranges, boundaries)
+
+
+def reuse_still_frames(video_clip, still_runs: StillRuns):
+    """
+    Make the first frame of every still run and hand it out again for the rest of the run, instead of evaluating
+    the clip for every frame. The clip must not change within a run, e.g. no effects depending on time.
+    """
+    if not still_runs.ranges:
+        return video_clip
+    last = {"key": None, "frame": None}
+
+    def frame_function(get_frame, t):
+        key = still_runs.key(t)
+        if key is not None and key == last["key"]:
+            return last["frame"]
+        frame = get_frame(t)
+        last["key"], last["frame"] = key, frame
+        return frame
+
+    return video_clip.transform(frame_function, apply_to=[])